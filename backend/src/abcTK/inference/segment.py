@@ -16,6 +16,7 @@ from rq.job import Job
 
 from abcTK.segment.engine import segmentationEngine
 from abcTK.writer import sanityWriter
+from abcTK.volume import LoadedVolume, get_dicom_series_files, read_dicom_series, probe_image_file
 import abcTK.database.collections as cl
 
 import dataclasses
@@ -24,6 +25,11 @@ import dataclasses
 bp = Blueprint('api/segment', __name__)
 logger = logging.getLogger(__name__)
 
+
+class SliceNotFoundError(ValueError):
+    #* No slice number for the requested level (not given, and not in the spine labelling)
+    pass
+
 #########################################################
 #* ==================== API =============================
 #########################################################
@@ -47,45 +53,114 @@ def infer_segment(req):
         logger.error("Make multiple requests to use multiple models.")
         raise ValueError("Vertebra should be a string representing a single level. Make multiple requests to use different models.")
 
-    req = handle_request(req)
+    ## Shared by every stage below: geometry/header from the file headers, pixels only read once when needed
+    volume = LoadedVolume(req['input_path'], req['loader_function'], loader_name)
+
+    req = handle_request(req, volume)
     output_dir = os.path.join(req['APP_OUTPUT_DIR'], req["project"], req["patient_id"], req["series_uuid"])
     os.makedirs(output_dir, exist_ok=True)
     req['output_dir'] = output_dir
     
-    Image = req['loader_function'](req['input_path'])
-    req['origin'] = Image.GetOrigin()
-    req['direction'] = Image.GetDirection()
-    req['size'] = Image.GetSize()
-    req['spacing'] = Image.GetSpacing()
+    req.update(volume.geometry) # origin, direction, size, spacing
 
     ## ++++++++++++++++   INFERENCE  +++++++++++++++++++++
     logger.info(f"Processing request: {req}")
     engine = segmentationEngine(**req)
-    data, paths_to_sanity = engine.forward(**req)
+    data, paths_to_sanity = engine.forward(volume=volume, **req)
     ###### UPDATE DATABASE ########
     update_database(req, data, paths_to_sanity)
     
     return 
 
 
+def infer_segment_multi(req):
+    """
+    Segment several vertebral levels of one image in a single job. The volume is loaded and pre-processed once
+    and each level's model (from model_bank) is run on it, with one database update at the end.
+    Same arguments as infer_segment, but `vertebrae` (list, default: every level with a model for the modality) replaces `vertebra`.
+    """
+    from abcTK.segment.model_bank import model_bank
+    logger.info(f"Request received: {req}")
+
+    check_params(req, required_params=["input_path", "project"])
+    loader_function, loader_name = get_loader_function(req['input_path'])
+    volume = LoadedVolume(req['input_path'], loader_function, loader_name)
+
+    modality = req.get('modality', 'CT')
+    levels = req.pop('vertebrae', None)
+    if levels is None:
+        levels = [k for k, v in model_bank.items() if modality in v.keys()]
+    elif isinstance(levels, str):
+        levels = ast.literal_eval(levels) if levels.startswith('[') else [x.strip() for x in levels.split(',')]
+    req.pop('vertebra', None)
+
+    if req.get('slab_loading') not in [None, False, 'false', 'False', '0', 'no']:
+        logger.info("Slab loading is per level, the full volume is loaded once for all levels instead.")
+    req['slab_loading'] = False
+
+    results, failed = {}, {} # failed: {vertebra: error}
+    preprocessed = None
+    spine_cache = {} # Spine prediction is the same for every level
+    for level in levels:
+        logger.info(f"==== Segmenting {level} ====")
+        try:
+            level_req = handle_request({**req, 'vertebra': level, 'loader_function': loader_function}, volume, spine_cache=spine_cache)
+        except SliceNotFoundError as e:
+            logger.warning(f"Skipping {level}: {e}")
+            continue
+        level_req['output_dir'] = os.path.join(level_req['APP_OUTPUT_DIR'], level_req["project"], level_req["patient_id"], level_req["series_uuid"])
+        os.makedirs(level_req['output_dir'], exist_ok=True)
+        level_req.update(volume.geometry) # origin, direction, size, spacing
+
+        logger.info(f"Processing request: {level_req}")
+        try:
+            engine = segmentationEngine(**level_req)
+            data, paths_to_sanity = engine.forward(volume=volume, preprocessed=preprocessed, **level_req)
+        except Exception as e:
+            ## One bad level (model, memory, ...) shouldn't lose the others, they're still written below
+            logger.exception(f"Segmentation of {level} failed")
+            failed[level] = f"{type(e).__name__}: {e}"
+            continue
+        preprocessed = engine.preprocessed
+        results[level] = (level_req, data, paths_to_sanity)
+
+    ###### UPDATE DATABASE ########
+    if results:
+        update_database_levels(results)
+
+    if failed:
+        raise RuntimeError(f"Segmentation failed for {list(failed.keys())} (written: {list(results.keys())}): {failed}")
+    if not results:
+        raise ValueError(f"Could not segment any of the requested levels: {levels}")
+    return
+
+
 ########################################################
 #* =============== HELPER FUNCTIONS =====================
 
 def update_database(req, data, paths_to_sanity):
+    update_database_levels({req['vertebra']: (req, data, paths_to_sanity)})
+
+
+def update_database_levels(results):
+    #* results: {vertebra: (req, data, paths_to_sanity)} for one image, written in one update per collection
     from app import mongo
 
     database = mongo.db
+    req = list(results.values())[-1][0] # Image-level fields are the same for every level
     query = database.quality_control.find_one({'_id': req['series_uuid'], 'project': req['project']},
                                                 {"_id": 1, "quality_control": 1, "paths_to_sanity_images": 1, 'qc_report': 1})
     labelling = database.images.find_one({'_id': req['series_uuid'], 'project': req['project']},
                                                 {"_id": 1, "labelling_done":1})
-    if labelling is not None:
-        req['labelling_done'] = labelling['labelling_done']
-    else:
-        req['labelling_done'] = False
-
-    qc = {req['vertebra']: {compartment: 2 for compartment in paths_to_sanity.keys() if compartment != 'ALL'}}
-    qc_report = {req['vertebra']: {}}
+    for level_req, _, _ in results.values():
+        level_req['labelling_done'] = labelling['labelling_done'] if labelling is not None else False
+
+    qc, qc_report, paths_to_sanity = {}, {}, {}
+    for vertebra, (_, _, level_paths) in results.items():
+        qc[vertebra] = {compartment: 2 for compartment in level_paths.keys() if compartment != 'ALL'}
+        qc_report[vertebra] = {}
+        for k, v in level_paths.items():
+            paths_to_sanity[k] = {**paths_to_sanity.get(k, {}), **v}
    
     if query is not None: 
         logger.info(f"++++ Found existing entry in db: {query} +++++")
@@ -122,14 +197,15 @@ def update_database(req, data, paths_to_sanity):
     
     ## Check if segmentation already done on this scan, if so update stats
     seg_query = database.segmentation.find_one({'_id': req['series_uuid'], 'project': req['project']}, {"_id": 1, "all_parameters": 1, "statistics": 1})
-    all_parameters = {req['vertebra']: {k: str(v) for k, v in req.items()}}
-    statistics = {req['vertebra']: data}
+    all_parameters = {vertebra: {k: str(v) for k, v in level_req.items()} for vertebra, (level_req, _, _) in results.items()}
+    statistics = {vertebra: data for vertebra, (_, data, _) in results.items()}
     if seg_query:
-        # Keep other levels but delete the one that has been segmented
-        if req['vertebra'] in seg_query['statistics']:
-            del seg_query['statistics'][req['vertebra']]
-        if req['vertebra'] in seg_query['all_parameters']:
-            del seg_query['all_parameters'][req['vertebra']]
+        # Keep other levels but delete the ones that have been segmented
+        for vertebra in results.keys():
+            if vertebra in seg_query['statistics']:
+                del seg_query['statistics'][vertebra]
+            if vertebra in seg_query['all_parameters']:
+                del seg_query['all_parameters'][vertebra]
 
         all_parameters.update(seg_query['all_parameters'])
         statistics.update(seg_query['statistics'])
@@ -154,7 +230,7 @@ def update_database(req, data, paths_to_sanity):
     logger.info(f"Inserted {qc_update.__dict__} into collection: quality_control")
     
 
-def handle_request(req):
+def handle_request(req, volume=None, spine_cache=None):
     header_keys = {
         'patient_id': '0010|0020',
         'study_uuid': '0020|000d',
@@ -170,12 +246,16 @@ def handle_request(req):
         #dcm_files = [x for x in os.listdir(req['input_path']) if x.endswith(('dcm', 'DICOM', 'DCM'))]
         # if len(dcm_files) == 0:
         #     raise ValueError(f"No dicom files found in input path: {req['input_path']}")
-        files = os.listdir(req['input_path'])
-        items = read_dicom_header(os.path.join(req["input_path"], files[0]), header_keys=header_keys)
+        if volume is not None:
+            ## Tags from the series that was actually loaded
+            items = volume.read_header(header_keys)
+        else:
+            files = os.listdir(req['input_path'])
+            items = read_dicom_header(os.path.join(req["input_path"], files[0]), header_keys=header_keys)
 
     elif os.path.isfile(req['input_path']):
         #TODO add reading nifti header
-        items = read_nifti_header(req['input_path'], header_keys=header_keys)
+        items = read_nifti_header(req['input_path'], header_keys=header_keys, volume=volume)
 
     ## Add to request
     for key, val in items.items():
@@ -255,13 +335,16 @@ def handle_request(req):
     # SLICE NUMBER
     if "slice_number" not in req:
         ## Check the spine collection for vertebra
-        if 'reference_scan' in req:
-            match = mongo.db.spine.find_one({"_id": req['reference_scan']})
+        spine_id = req['reference_scan'] if 'reference_scan' in req else req['series_uuid']
+        if spine_cache is not None and spine_id in spine_cache:
+            match = spine_cache[spine_id]
         else:
-            match = mongo.db.spine.find_one({"_id": req['series_uuid']})
+            match = mongo.db.spine.find_one({"_id": spine_id})
+            if spine_cache is not None:
+                spine_cache[spine_id] = match
 
         if match is None or req["vertebra"] not in match["prediction"]:
-            raise ValueError("Could not find a slice number for the requested vertebra.")
+            raise SliceNotFoundError("Could not find a slice number for the requested vertebra.")
 
         req['slice_number'] = match["prediction"][req["vertebra"]][-1]
         logger.info(f"Found slice number {req['slice_number']} for {req['vertebra']}")
@@ -301,6 +384,24 @@ def handle_request(req):
     elif type(req["num_slices"]) == str:
         req['num_slices'] = int(req['num_slices'])
 
+    # INFERENCE BATCH SIZE
+    if "inference_batch_size" not in req:
+        ## Send every slice through the model in one call (if the model allows it)
+        req["inference_batch_size"] = None
+    elif type(req["inference_batch_size"]) == str:
+        req['inference_batch_size'] = None if req['inference_batch_size'].lower() == 'none' else int(req['inference_batch_size'])
+
+    # SLAB LOADING
+    if 'slab_loading' not in req:
+        req['slab_loading'] = False
+    elif isinstance(req['slab_loading'], str):
+        if req['slab_loading'].lower() in ['false', '0', 'no']:
+            req['slab_loading'] = False
+        elif req['slab_loading'].lower() in ['true', '1', 'yes']:
+            req['slab_loading'] = True
+        else:
+            raise ValueError(f"Can't convert slab_loading arg ({req['slab_loading']}) to bool")
+
     ## Muscle and fat thresholds
     if 'muscle_threshold' in req:
         req['muscle_threshold'] = ast.literal_eval(req['muscle_threshold'])
@@ -390,10 +491,7 @@ def get_loader_function(path):
 
     def load_dcm(path):
         #* Read DICOM directory
-        reader = sitk.ImageSeriesReader()
-        dcm_names = reader.GetGDCMSeriesFileNames(path)
-        reader.SetFileNames(dcm_names)
-        return reader.Execute()
+        return read_dicom_series(get_dicom_series_files(path))
 
     if os.path.isdir(path):
         ## Check at least one dicom file
@@ -429,16 +527,16 @@ def get_loader_function(path):
         logger.warning("Input is not a directory or a file... Not sure how you did that")
 
 
-def read_nifti_header(path, header_keys):
-    Image = sitk.ReadImage(path)
+def read_nifti_header(path, header_keys, volume=None):
+    #* Spacing from the header only
+    spacing = volume.spacing if volume is not None else probe_image_file(path)['spacing']
     data = {}
     for k in header_keys.keys():
         if k == 'pixel_spacing':
-            spacing = Image.GetSpacing()[:-1]
             data['X_spacing'] = str(spacing[0])
             data['Y_spacing'] = str(spacing[1])
         if k == 'slice_thickness':
-            thickness = Image.GetSpacing()[-1]
+            thickness = spacing[-1]
             data[k] = thickness
         if k in ['acquisition_date', 'study_uuid', 'series_date', 'study_date']:
             #TODO get this from header
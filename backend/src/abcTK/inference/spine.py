@@ -8,12 +8,14 @@ from datetime import datetime
 from flask import Blueprint
 import SimpleITK as sitk
 import json
+import shutil
 import logging
 import dataclasses
 from tqdm import tqdm
 
 from abcTK.spine.server import spineApp
 from abcTK.writer import sanityWriter
+from abcTK.volume import LoadedVolume, get_dicom_series_files, read_dicom_series, probe_image_file
 import abcTK.database.collections as cl
 
 
@@ -23,6 +25,20 @@ import abcTK.database.collections as cl
 bp = Blueprint('api/spine', __name__)
 logger = logging.getLogger(__name__)
 
+#* Spine app kept alive between jobs in the same worker process (workers run jobs in-process with
+#* rq.SimpleWorker, see docker-compose.yml), so model discovery/construction only happens for the first
+#* job and the networks stay loaded for the rest. segment_vertebra is added to it by the first job that needs it.
+_app = None
+
+#* Centroids only need the first two stages, segment_vertebra is only loaded if masks are requested
+CENTROID_MODELS = "find_spine,find_vertebra"
+SEGMENTATION_MODELS = "find_spine,find_vertebra,segment_vertebra"
+
+#* Device the spine models run on: auto (GPU if there is one), cuda or cpu.
+#* SPINE_TORCH_THREADS limits the threads torch uses on CPU (0 -> torch default, every core)
+SPINE_DEVICE = os.environ.get('SPINE_DEVICE', 'auto').lower()
+SPINE_TORCH_THREADS = int(os.environ.get('SPINE_TORCH_THREADS', 0))
+
 #########################################################
 #* ==================== API =============================
 #########################################################
@@ -32,28 +48,27 @@ def infer_spine(req):
     from app import mongo
     logger.info(f"Request received: {req}")
 
-    if not torch.cuda.is_available():
-        logger.error("No GPU detected")
-        raise ValueError("No GPU detected") ## Internal server error 
+    device = get_device()
 
     check_params(req, required_params=["input_path", "project"])
     req['loader_function'] = get_loader_function(req['input_path'])
 
-    req = handle_request(req)
+    # Geometry/header come from the file headers, pixels are only decoded for the sanity image
+    loader_function, loader_name = req['loader_function']
+    dcm_names = get_dicom_series_files(req['input_path'], largest_series=True) if loader_name == 'dicom' else None
+    volume = LoadedVolume(req['input_path'], loader_function, loader_name, dcm_names=dcm_names)
+
+    req = handle_request(req, volume)
 
     if req['modality'] != 'CT':
         raise ValueError(f"Spine labelling limited to CT ... Image is: {req['modality']}") ## Internal server error 
 
-    # Load the image into SimpleITK and extract image info --> Needed for resampling onto this image
-    Image = req['loader_function'][0](req['input_path'])
-    req['origin'] = Image.GetOrigin()
-    req['direction'] = Image.GetDirection()
-    req['size'] = Image.GetSize()
-    req['spacing'] = Image.GetSpacing()
+    # Image info --> Needed for resampling onto this image
+    req.update(volume.geometry)
 
     logger.info(f"Processing: {req}")
-    ## Start the spineApp
-    app = init_app()
+    ## Get the (warm) spineApp
+    app = get_app(SEGMENTATION_MODELS if req['segment_vertebrae'] else CENTROID_MODELS)
     
     output_dir = os.path.join(req['APP_OUTPUT_DIR'], req["project"], req['patient_id'], req["series_uuid"])
     
@@ -64,12 +79,14 @@ def infer_spine(req):
     response = app.infer(request = {
         "model": "vertebra_pipeline", 
         "image": req['input_path'],
-        "worldmatch_correction": req['worldmatch_correction']
+        "device": device,
+        "worldmatch_correction": req['worldmatch_correction'],
+        "segment_vertebrae": req['segment_vertebrae'],
         })#
 
     logger.info(f"Spine labelling complete: {response}")
     
-    res, output_filename = handle_response(req['input_path'], response, output_dir, req['loader_function'][0])
+    res, output_filename = handle_response(volume.Image, response, output_dir, req['loader_function'][0])
     
     #######  UPDATE DATABASE #######
     # Updates
@@ -121,7 +138,7 @@ def update_database(request, response, output_dir):
 
 
 
-def handle_request(req):
+def handle_request(req, volume=None):
     ## Handle paramaters and extract info from dicom header if not provided.
 
     header_keys = {
@@ -150,13 +167,16 @@ def handle_request(req):
             else:
                 logger.warning(f"No series found with series_uuid: {req['series_uuid']}.\n Assuming this is a custom uuid and that all files in {req['input_path']} belong to one series.")
                 items = read_dicom_header(os.path.join(req["input_path"], files[0]), header_keys=header_keys)
+        elif volume is not None:
+            ## Tags from the series that was actually loaded
+            items = volume.read_header(header_keys)
         else:
             items = read_dicom_header(os.path.join(req["input_path"], files[0]), header_keys=header_keys)
 
 
     elif os.path.isfile(req['input_path']):
         #TODO add reading nifti header
-        items = read_nifti_header(req['input_path'], header_keys=header_keys)
+        items = read_nifti_header(req['input_path'], header_keys=header_keys, volume=volume)
     else:
         raise ValueError("input_path is not a directory or a file.")
 
@@ -208,6 +228,17 @@ def handle_request(req):
         else:
             raise ValueError("Worldmatch correction should be a string (True/False)")
             
+    # VERTEBRA MASKS (third stage)
+    if 'segment_vertebrae' not in req:
+        req['segment_vertebrae'] = False
+    elif isinstance(req['segment_vertebrae'], str):
+        if req['segment_vertebrae'].lower() in ['false', '0', 'no']:
+            req['segment_vertebrae'] = False
+        elif req['segment_vertebrae'].lower() in ['true', '1', 'yes']:
+            req['segment_vertebrae'] = True
+        else:
+            raise ValueError(f"Can't convert segment_vertebrae arg ({req['segment_vertebrae']}) to bool")
+
     # MODALITY
     if "modality" not in req:
         ## If user doesn't provide modality, add default (CT)
@@ -229,18 +260,7 @@ def get_loader_function(path):
     def load_dcm(path):
         #* Read DICOM directory
 
-        reader = sitk.ImageSeriesReader()
-        dcm_names = [reader.GetGDCMSeriesFileNames(path, series_id) for series_id in reader.GetGDCMSeriesIDs(path)]
-        assert len(dcm_names) > 0, f"No DICOM series found in {path}"
-        ## If more than 1
-        logger.info(f"Detected {len(dcm_names)} series in directory.")
-        if len(dcm_names) > 1:
-            ## Select the one with most files and read that
-            logger.warning("Multiple series detected, selecting the one with most files.")
-            dcm_names.sort(key=len, reverse=True)
-
-        reader.SetFileNames(dcm_names[0])
-        return reader.Execute()
+        return read_dicom_series(get_dicom_series_files(path, largest_series=True))
 
     if os.path.isdir(path):
         ## Check at least one dicom file
@@ -316,13 +336,38 @@ def check_params(req, required_params = ["input", "project", "patient_id", "scan
         raise ValueError(f"Some required parameters are missing. Did you provide the following? {required_params}") ## Bad request
 
 
-def init_app():
+def get_device():
+    if SPINE_DEVICE not in ['auto', 'cuda', 'cpu']:
+        raise ValueError(f"Unrecognised SPINE_DEVICE: {SPINE_DEVICE}. Use one of: auto, cuda, cpu")
+    if SPINE_DEVICE == 'cuda' and not torch.cuda.is_available():
+        logger.error("No GPU detected")
+        raise ValueError("No GPU detected") ## Internal server error 
+    if SPINE_DEVICE == 'cpu' or not torch.cuda.is_available():
+        logger.info(f"Running spine labelling on CPU with {torch.get_num_threads()} threads")
+        return 'cpu'
+    return 'cuda'
+
+
+def get_app(models=CENTROID_MODELS):
+    global _app
+    if _app is None:
+        logger.info(f"Initialising spine app for this worker with models: {models}")
+        _app = init_app(models)
+    else:
+        logger.info(f"Re-using spine app initialised by a previous job, loading any of {models} it's missing")
+        _app.add_models([m.strip() for m in models.split(",")])
+    return _app
+
+
+def init_app(models=CENTROID_MODELS):
     # Initialise the spine app
+    if SPINE_TORCH_THREADS > 0:
+        torch.set_num_threads(SPINE_TORCH_THREADS)
     
     app_dir = os.path.dirname(__file__)
     studies =  "https://127.0.0.1:8989" #Just points to an empty address - needed for monaiLabelApp
     config = {
-        "models": "find_spine,find_vertebra,segment_vertebra",
+        "models": models,
         "preload": "false",
         "use_pretrained_model": "true"
     }   
@@ -337,9 +382,10 @@ def json_to_file(json_payload, output_path, filename='spine-output.json'):
     with open(output_filename, 'w') as f:
         json.dump(json_payload, f)
 
-def handle_response(image_path, res, output_dir, loader_function):
+def handle_response(image, res, output_dir, loader_function):
     """
     Handle the reply from inference 
+    image: SimpleITK image already loaded by the job (or a path, loaded with loader_function)
     """
     json_output_path = os.path.join(output_dir, 'json')
     os.makedirs(json_output_path, exist_ok=True)
@@ -354,22 +400,28 @@ def handle_response(image_path, res, output_dir, loader_function):
         res['status_code'] = 500
         output_filename = None
     
-    elif label is None and label_json is not None:
+    elif label_json is not None:
+        if label is not None:
+            ## Per-vertebra mask from the third stage (segment_vertebrae)
+            mask_dir = os.path.join(output_dir, 'masks')
+            os.makedirs(mask_dir, exist_ok=True)
+            res['mask_path'] = os.path.join(mask_dir, 'VERTEBRAE.nii.gz')
+            shutil.move(label, res['mask_path'])
+            logger.info(f"Vertebra masks written to: {res['mask_path']}")
+
         ## Prettify the json
         json_to_file(label_json, json_output_path, filename='all-spine-outputs.json')
         pretty_json = prettify_json(label_json)
         json_to_file(pretty_json, json_output_path)
-        output_filename = writer.write_spine_sanity('SPINE', image_path, pretty_json, loader_function)
+        output_filename = writer.write_spine_sanity('SPINE', image, pretty_json, loader_function)
 
         res['status_code'] = 200
         res['prediction'] = pretty_json
         res['quality_control_image'] = output_filename
 
     else:
-        # This should never happen... Would like to add this though
-        logger.error("Somehow you got here.\
-                      This means the spine module tried to write vertebral masks, which hasn't been implemented.\
-                      I have no idea how you managed that... Well done!!")
+        # This should never happen...
+        logger.error("Somehow you got here. The spine module returned a mask without centroids.")
 
         res['status_code'] = 500
         output_filename = None
@@ -387,16 +439,16 @@ def prettify_json(input_json):
             dict_[level] = [x for x in val[1:]]
     return dict_
 
-def read_nifti_header(path, header_keys):
-    Image = sitk.ReadImage(path)
+def read_nifti_header(path, header_keys, volume=None):
+    #* Spacing from the header only
+    spacing = volume.spacing if volume is not None else probe_image_file(path)['spacing']
     data = {}
     for k in header_keys.keys():
         if k == 'pixel_spacing':
-            spacing = Image.GetSpacing()[:-1]
             data['X_spacing'] = str(spacing[0])
             data['Y_spacing'] = str(spacing[1])
         if k == 'slice_thickness':
-            thickness = Image.GetSpacing()[-1]
+            thickness = spacing[-1]
             data[k] = thickness
         if k in ['acquisition_date', 'study_uuid', 'series_uuid']:
             #TODO get this from header
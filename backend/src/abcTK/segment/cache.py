@@ -0,0 +1,88 @@
+"""
+On-disk cache of pre-processed input volumes (reoriented to LPS, intensity corrected) and bone masks.
+Segmentation jobs for other levels of the same scan memory-map these instead of re-loading and
+re-processing the volume. Each entry is a directory with image.npy, bone.npy (optional) and meta.json.
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+#* Set PREPROCESS_CACHE_DIR to enable. Least recently used entries are removed above PREPROCESS_CACHE_MAX_SIZE_GB.
+CACHE_DIR = os.environ.get('PREPROCESS_CACHE_DIR', '')
+CACHE_MAX_SIZE_GB = float(os.environ.get('PREPROCESS_CACHE_MAX_SIZE_GB', 20))
+CACHE_VERSION = 1 # Bump if what's stored (or how it's computed) changes
+
+
+def get_cache_key(series_uuid, input_path, **params):
+    #* Hash of the scan and every parameter that changes the pre-processed volume
+    if not CACHE_DIR or series_uuid is None:
+        return None
+    key = {'version': CACHE_VERSION, 'series_uuid': series_uuid, 'input_path': input_path,
+           'input_mtime': os.path.getmtime(input_path), **params}
+    return hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def read(key):
+    #* Returns (image, bone, meta) with arrays memory-mapped read-only, or None on a miss
+    entry = os.path.join(CACHE_DIR, key)
+    if not os.path.isfile(os.path.join(entry, 'meta.json')):
+        return None
+    try:
+        with open(os.path.join(entry, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        image = np.load(os.path.join(entry, 'image.npy'), mmap_mode='r')
+        bone = np.load(os.path.join(entry, 'bone.npy'), mmap_mode='r') if meta['has_bone'] else None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not read pre-processing cache entry {entry}: {e}")
+        return None
+    os.utime(entry) # Mark as recently used
+    logger.info(f"Loaded pre-processed volume from cache: {entry}")
+    return image, bone, meta
+
+
+def write(key, image, bone, meta):
+    entry = os.path.join(CACHE_DIR, key)
+    if os.path.isdir(entry):
+        return
+    ## Write to a private directory then rename, other workers may be caching the same scan
+    tmp_entry = f"{entry}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(tmp_entry, exist_ok=True)
+        np.save(os.path.join(tmp_entry, 'image.npy'), image)
+        if bone is not None:
+            np.save(os.path.join(tmp_entry, 'bone.npy'), bone)
+        with open(os.path.join(tmp_entry, 'meta.json'), 'w') as f:
+            json.dump({**meta, 'has_bone': bone is not None}, f)
+        os.rename(tmp_entry, entry)
+        logger.info(f"Cached pre-processed volume: {entry}")
+    except OSError as e:
+        logger.warning(f"Could not write pre-processing cache entry {entry}: {e}")
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        return
+    evict(int(CACHE_MAX_SIZE_GB * 1024**3))
+
+
+def evict(max_bytes):
+    #* Remove least recently used entries until the cache fits in max_bytes
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        path = os.path.join(CACHE_DIR, name)
+        if name.endswith('.tmp') or not os.path.isdir(path):
+            continue
+        size = sum(os.path.getsize(os.path.join(path, x)) for x in os.listdir(path))
+        entries.append((os.path.getmtime(path), size, path))
+
+    total = sum(x[1] for x in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        logger.info(f"Evicting pre-processing cache entry: {path}")
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
@@ -4,6 +4,7 @@ Base class for segmentation engine
 
 import os
 import ast
+import json
 import time
 import logging
 import SimpleITK as sitk
@@ -11,24 +12,35 @@ import numpy as np
 from scipy import signal
 import pydicom
 
-import torch
-import onnx
+import cv2
 import onnxruntime as ort
-import albumentations as A
-
-from albumentations.pytorch.transforms import ToTensorV2
-from monai.transforms.spatial.functional import resize
-from scipy.special import softmax
-import skimage
-from scipy.ndimage import binary_dilation, generate_binary_structure
+from scipy.ndimage import binary_dilation, generate_binary_structure, convolve1d
 from flask import abort
 from rt_utils import RTStructBuilder
 
 from abcTK.writer import sanityWriter
-from abcTK.wrapper import ONNXInferenceWrapper
+from abcTK.wrapper import get_inference_session, resolve_session_config
+import abcTK.segment.cache as preprocess_cache
+import abcTK.segment.mask_store as mask_store
+from abcTK.segment.holder import SlabHolder
+import abcTK.segment.masks as masks
 
 logger = logging.getLogger(__name__)
 
+#* Slab loading: extra slices decoded either side of the segmented ones, so the bone mask dilation
+#* (radius in mm) and the IMAT Gaussian blur see the same neighbourhood as with the full volume.
+BONE_MASK_RADIUS = 3
+IMAT_BLUR_MARGIN = 4
+
+#* Model input: slices resized to INPUT_SIZE (H, W), 3 channels with ImageNet normalisation
+INPUT_SIZE = (512, 512)
+IMAGENET_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32).reshape(1, 3, 1, 1)
+IMAGENET_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32).reshape(1, 3, 1, 1)
+CV_MAX_CHANNELS = 512 # Most channels cv2.resize takes in one call
+#* Models prepared with abcTK/segment/prepare_model.py do the above in the graph, settings in their metadata under this key
+PREPROCESSING_KEY = 'abc_preprocessing'
+RAW_INPUT_DTYPES = {'int16': np.int16, 'float32': np.float32}
+
 class segmentationEngine():
     def __init__(self, output_dir, modality, vertebra, worldmatch_correction, fat_threshold=(-190, -30), muscle_threshold=(-29, 150), series_uuid=None,
                  model_bank=None, **kwargs):
@@ -49,26 +61,16 @@ class segmentationEngine():
         }
 
         self._init_model_bank(model_bank) #* Load bank of models
-        #self._set_options() #* Set ONNX session options
+        self.session_config = self._set_options(**kwargs) #* Set ONNX session options
 
-        #self.ort_session = ort.InferenceSession(self.model_paths[modality], sess_options=self.sess_options)
-        onnx_model = onnx.load(self.model_paths[modality]['path'])
-        self.ort_session = ONNXInferenceWrapper(self.model_paths[modality]['path'], onnx_model)
+        self.ort_session = get_inference_session(self.model_paths[modality]['path'], self.session_config) #* Cached per worker process
+        self.preprocessing = self._get_model_preprocessing() #* None unless the model takes raw slices
         
         self.segment_dict = self.model_paths[modality]['segments']
         self.segments = [x for x in self.segment_dict.keys()]
-
-
-        #* ImageNet pre-processing transforms
-        self.transforms = A.Compose([
-            A.Resize(512, 512),
-            A.Normalize(mean=(0.485, 0.456, 0.406), 
-            std=(0.229, 0.224, 0.225), max_pixel_value=1),
-            ToTensorV2()
-            ],)
     
     
-    def forward(self, input_path, slice_number, num_slices, loader_function, generate_bone_mask, **kwargs):
+    def forward(self, input_path, slice_number, num_slices, loader_function, generate_bone_mask, volume=None, preprocessed=None, **kwargs):
         ###* ++++++++++ PRE-PROCESS +++++++++++++++++
         self.loader_function = loader_function ## TO re-use in plotting.
         mask_dir = os.path.join(self.output_dir, 'masks')
@@ -76,26 +78,28 @@ class segmentationEngine():
         start = time.time()
         
         #Reorient, resample, calc. slice number 
-        origImage, Image, image = self.load_data(input_path, generate_bone_mask, mask_dir, slice_number, **kwargs)
+        origImage, Image, image = self.load_data(input_path, generate_bone_mask, mask_dir, slice_number, volume=volume, num_slices=num_slices,
+                                                 preprocessed=preprocessed, **kwargs)
+        #* Re-usable by engines for other levels of the same image (see infer_segment_multi)
+        self.preprocessed = {'origImage': origImage, 'Image': Image, 'image': image, 'bone': self.bone, 'flipped': self.flipped,
+                             'slice_scale': self.slice_scale, 'reference_geometry': self.reference_geometry, 'cached_geometry': self.cached_geometry}
 
-        #* Create some holders to put predictions
-        #TODO Should predictions be written to disk? Slower but less mem. w/ big input res.
-        holder = np.zeros_like(image, dtype=np.int8)
-        self.holders = { x: holder.copy() for x in self.segments}
+        #* Create some holders to put predictions, only the slices being segmented are stored
+        self.num_slices = num_slices
+        self.holders = { x: SlabHolder(image.shape, self.slice_number - num_slices, self.slice_number + num_slices + 1)
+                        for x in self.segments}
 
         #* Subset the reference image
-        self.num_slices = num_slices
         self.img = self.prepare_multi_slice(image)
 
         pre_processing_time = time.time() - start
         logger.info(f"Pre-processing: {pre_processing_time} s")
 
         ###* ++++++++++ INFERENCE +++++++++++++++++
-        #TODO This can be parallelised
         logger.info(f"==== INFERENCE ====")
         start = time.time()
-        for i in range(self.img.shape[0]):
-            self.per_slice_inference(i)
+        for batch in self.get_batches(kwargs.get('inference_batch_size')):
+            self.batch_inference(batch)
 
         inference_time = time.time() - start
         logger.info(f"Total inference: {inference_time} s")
@@ -143,7 +147,7 @@ class segmentationEngine():
         logger.info(f"Slice number: {self.slice_number}. Num slices: {self.num_slices}")
         self.holders = {}
         if compartment == 'total_muscle':
-            self.holders['skeletal_muscle'] = mask
+            self.holders['skeletal_muscle'] = SlabHolder.from_array(mask)
             self.extract_imat(image)
             # Rename to deal with post-processing
             compartment = 'skeletal_muscle' 
@@ -157,14 +161,39 @@ class segmentationEngine():
     ###############################################
 
 
-    def load_data(self, input_path, generate_bone_mask, mask_dir, slice_number, **kwargs):
-        #* Load input volume
-        origImage = self.loader_function(input_path) # Returns SimpleITK image and reference slice
+    def load_data(self, input_path, generate_bone_mask, mask_dir, slice_number, volume=None, num_slices=0, preprocessed=None, **kwargs):
+        self.volume = volume
+        self.slice_offset = 0 # Slab loading: index of the first loaded slice in the full (reoriented) volume
+        self.slice_scale = 1 # Resampling: slice number scaling
+        self.reference_geometry = None # Slab/cache: grid of the full volume, to write masks onto
+        self.cached_geometry = None
+
+        if preprocessed is not None:
+            #* Already loaded and pre-processed by another level's engine
+            return self.load_preprocessed(preprocessed, slice_number)
+
+        #* Load input volume, unless already read for this job (abcTK/volume.py)
+        slab_range = self.get_slab_range(volume, slice_number, num_slices, **kwargs)
+        cache_key = self.get_cache_key(volume, generate_bone_mask, slab_range, **kwargs)
+        cached = preprocess_cache.read(cache_key) if cache_key is not None else None
+        if cached is not None:
+            return self.load_cached(cached, slice_number)
+
+        if slab_range is not None:
+            start, stop = slab_range
+            origImage = volume.read_slab(start, stop)
+            slice_number = int(slice_number) - start
+            self.reference_geometry = volume.geometry
+        elif volume is not None:
+            origImage = volume.Image
+        else:
+            origImage = self.loader_function(input_path) # Returns SimpleITK image and reference slice
         
         if 'resample' in kwargs and kwargs['resample']:
             if 'resample_spacing' in kwargs:
                 logger.info(f"Resampling image (shape: {origImage.GetSize()}) from spacing {origImage.GetSpacing()} to {kwargs['resample_spacing']}")
                 origImage, ratio = self.resample_image(origImage, output_spacing=kwargs['resample_spacing'])
+                self.slice_scale = ratio[-1]
                 if slice_number is not None:
                     slice_number = slice_number * ratio[-1]
 
@@ -267,11 +296,15 @@ class segmentationEngine():
         
         
         Image, orient = self.reorient(origImage, orientation='LPS')
+        self.flipped = bool(orient.GetFlipAxes()[-1])
         #* Flip the slice number if the image was flipped
         if orient.GetFlipAxes()[-1] and slice_number is not None:
             logger.info(f"Original slice number: {slice_number}")
             slice_number = Image.GetSize()[-1] - int(slice_number) - 1 # Since size starts at 1 but indexing starts at 0
             logger.info(f'New slice number: {slice_number}')
+        if slab_range is not None:
+            self.slice_offset = volume.size[-1] - slab_range[1] if orient.GetFlipAxes()[-1] else slab_range[0]
+            logger.info(f"Slab loaded, slice {slice_number} of the slab is slice {slice_number + self.slice_offset} of the volume")
         
         self.slice_number = slice_number
 
@@ -299,7 +332,10 @@ class segmentationEngine():
             # Regenerat
             logger.info("Generating bone mask")
             Bone = self.generate_bone_mask_CT(Image, pixel_spacing)
-            sitk.WriteImage(Bone, os.path.join(mask_dir, 'BONE.nii.gz'))
+            if self.reference_geometry is not None:
+                sitk.WriteImage(self.resample_to_geometry(Bone, self.reference_geometry, sitk.sitkNearestNeighbor), os.path.join(mask_dir, 'BONE.nii.gz'))
+            else:
+                sitk.WriteImage(Bone, os.path.join(mask_dir, 'BONE.nii.gz'))
             Bone, _ = self.reorient(Bone, orientation='LPS')
             self.bone = sitk.GetArrayFromImage(Bone)
             self.bone = np.logical_not(self.bone)
@@ -310,14 +346,94 @@ class segmentationEngine():
             Bone = sitk.ReadImage(generate_bone_mask)
             Bone, _ = self.reorient(Bone, orientation='LPS')
             self.bone = sitk.GetArrayFromImage(Bone)
+            if slab_range is not None:
+                #* Bone mask covers the whole volume, keep the slices of the loaded slab (LPS, like the image)
+                if self.bone.shape[0] != volume.size[-1]:
+                    raise ValueError(f"Bone mask ({Bone.GetSize()}) doesn't match the input volume ({volume.size})")
+                self.bone = self.bone[self.slice_offset:self.slice_offset + image.shape[0]]
             self.bone = np.logical_not(self.bone)
         else:
             self.bone = None
 
+        if cache_key is not None:
+            meta = {'geometry': self.get_geometry(Image), 'original_geometry': self.get_geometry(origImage), 'flipped': self.flipped}
+            preprocess_cache.write(cache_key, self.image, self.bone, meta)
+
         ## Return the original SimpleITK Image, the reoriented/resampled SimpleITK Image and the numpy array image
         return origImage, Image, image
 
-    def generate_bone_mask_CT(self, Image, pixel_spacing, threshold = 350, radius = 3):
+    def get_cache_key(self, volume, generate_bone_mask, slab_range, **kwargs):
+        #* Key for the pre-processed volume cache (abcTK/segment/cache.py), None if this job shouldn't use it
+        if volume is None or slab_range is not None:
+            return None
+        if kwargs.get('resample') or kwargs.get('calibrate_cbct'):
+            return None
+        bone_mask = generate_bone_mask
+        if type(generate_bone_mask) == str:
+            bone_mask = [generate_bone_mask, os.path.getmtime(generate_bone_mask)]
+        return preprocess_cache.get_cache_key(self.series_uuid, volume.path, worldmatch_correction=self.worldmatch_correction,
+                                              shift_intensity=kwargs.get('shift_intensity'), scale_intensity=kwargs.get('scale_intensity'),
+                                              generate_bone_mask=bone_mask)
+
+    def load_cached(self, cached, slice_number):
+        #* Pre-processed volume from the cache: arrays are memory-mapped (read-only), the SimpleITK images aren't rebuilt,
+        #* masks are written onto the original grid stored alongside.
+        image, bone, meta = cached
+        preprocessed = {'origImage': None, 'Image': meta['geometry'], 'image': image, 'bone': bone, 'flipped': meta['flipped'],
+                        'slice_scale': 1, 'reference_geometry': meta['original_geometry'], 'cached_geometry': meta['geometry']}
+        return self.load_preprocessed(preprocessed, slice_number)
+
+    def load_preprocessed(self, preprocessed, slice_number):
+        #* Pick up a volume pre-processed by load_data, only the slice number needs converting
+        for key in ['bone', 'flipped', 'slice_scale', 'reference_geometry', 'cached_geometry']:
+            setattr(self, key, preprocessed[key])
+        self.image = preprocessed['image']
+        if slice_number is not None:
+            slice_number = slice_number * self.slice_scale
+            if self.flipped:
+                slice_number = self.image.shape[0] - int(slice_number) - 1
+                logger.info(f'New slice number: {slice_number}')
+        self.slice_number = slice_number
+        return preprocessed['origImage'], preprocessed['Image'], preprocessed['image']
+
+    def get_slab_range(self, volume, slice_number, num_slices, **kwargs):
+        #* [start, stop) slices to decode in slab loading mode, or None to load the whole volume
+        if volume is None or not kwargs.get('slab_loading') or slice_number is None:
+            return None
+        if kwargs.get('resample') or kwargs.get('calibrate_cbct'):
+            logger.info("Slab loading not supported with resampling/calibration, loading the full volume")
+            return None
+        if not volume.supports_slab:
+            logger.info(f"Slab loading not supported for this input ({volume.loader_name}), loading the full volume")
+            return None
+        direction = np.array(volume.direction).reshape(3, 3)
+        if np.argmax(np.abs(direction[:, -1])) != 2:
+            #* Slices would not stay the last axis once reoriented to LPS
+            logger.info("Slab loading only supported for axial slices, loading the full volume")
+            return None
+
+        margin = int(BONE_MASK_RADIUS // volume.spacing[-1]) + IMAT_BLUR_MARGIN
+        start = max(int(slice_number) - num_slices - margin, 0)
+        stop = min(int(slice_number) + num_slices + margin + 1, volume.size[-1])
+        if start >= stop:
+            raise ValueError(f"Slice number {slice_number} is outside the volume (size: {volume.size})")
+        return start, stop
+
+    def get_full_image(self, originalImage):
+        #* Original image for the whole-volume sanity images (decoded here if only a slab was loaded)
+        if self.reference_geometry is None:
+            return originalImage
+        elif self.cached_geometry is not None:
+            ## Cached volume is intensity corrected, which doesn't change a MIP. It is in LPS, put it back in the
+            ## input's orientation so the spine labels (voxel indices of the input) line up with it
+            Image = self.npy2itk(self.image, self.cached_geometry)
+            mapping = self.grid_mapping(Image, self.reference_geometry)
+            if mapping is not None:
+                return self.remap_to_geometry(np.asarray(self.image), mapping, self.reference_geometry)
+            return self.resample_to_geometry(Image, self.reference_geometry, sitk.sitkLinear)
+        return self.volume.Image
+
+    def generate_bone_mask_CT(self, Image, pixel_spacing, threshold = 350, radius = BONE_MASK_RADIUS):
         #~ Create bone mask (by thresholding) for handling partial volume effect
         #@threshold in HU; radius in mm.
         logger.info(f"Generating bone mask using threshold ({threshold}) and expanding isotropically by {radius} mm")
@@ -351,83 +467,116 @@ class segmentationEngine():
         This prepares multi-slice inputs and maintains slice # to index mapping.
         i.e. Batch size = 2*num_slices + 1  
         """
-        self.idx2slice = {}
         logger.info(f"Pre-processing input slices (# slices: {self.num_slices*2 +1})")
-        for i, slice_ in enumerate( np.arange(self.slice_number- self.num_slices, self.slice_number+self.num_slices+1) ):
-            im_tensor = self.pre_process(image, slice_)
-
-            if im_tensor is None:
-                logger.warn(f"The selected slice ({slice_}) is out of range - skipping.")
-                continue
-
-            if i == 0:
-                img = im_tensor[None]
-            else:
-                img = torch.cat([img, im_tensor[None]], axis=0)
-            self.idx2slice[i] = slice_
-
-        return np.array(img)
-    
-    def pre_process(self, image, slice_number):
-        #* Pre-processing
-        try:
-            im = image[slice_number]
-        except IndexError: #* Slice out of bounds
-            return None
+        slices = np.arange(int(self.slice_number) - self.num_slices, int(self.slice_number) + self.num_slices+1) # Scaled slice numbers can be float
+        in_range = (slices >= 0) & (slices < image.shape[0])
+        for slice_ in slices[~in_range]:
+            logger.warn(f"The selected slice ({slice_}) is out of range - skipping.")
+        slices = slices[in_range]
+        if len(slices) == 0:
+            raise ValueError(f"Slice {self.slice_number} is out of range for an image with {image.shape[0]} slices")
+        self.idx2slice = {i: int(slice_) for i, slice_ in enumerate(slices)}
 
         self.settings = self._get_window_level()
+        if self.preprocessing is not None:
+            return self.prepare_raw(image[slices])
+        return self.pre_process(image[slices])
+    
+    def pre_process(self, slab):
+        #* Window/level, resize and normalise a stack of slices (N x H x W) in one go,
+        #* returns the float32 model input (N x 3 x INPUT_SIZE)
         logger.info(f"Window/Level ({self.settings['window']}/{self.settings['level']}) normalisation")
-        im = self.wl_norm(im, window=self.settings['window'], level=self.settings['level'])
-        
-        logger.info(f"Converting input to three channels")
-        im = self.expand(im) #* 3 channels
-        logger.info(f"Applying transforms: {self.transforms}")
-        augmented = self.transforms(image=im)
-        return augmented['image']
+        wld = self.wl_norm(np.asarray(slab, dtype=np.float32), window=self.settings['window'], level=self.settings['level'])
+
+        resized = self.resize_slices(wld, INPUT_SIZE)
+
+        #* Same intensities in all 3 channels, ImageNet mean/std per channel
+        batch = np.empty((len(wld), 3, *INPUT_SIZE), dtype=np.float32)
+        batch[:] = resized[:, None]
+        batch -= IMAGENET_MEAN
+        batch /= IMAGENET_STD
+        return batch
+
+    def prepare_raw(self, slab):
+        #* Model input for prepared models: the slices as they are (N x 1 x H x W), window/level etc. run in the graph
+        logger.info(f"Model does its own pre-processing: {self.preprocessing}")
+        slab = np.asarray(slab)
+        size = tuple(self.preprocessing['input_size'])
+        if not self.preprocessing['resize'] and slab.shape[-2:] != size:
+            slab = self.resize_slices(slab.astype(np.float32), size)
+        dtype = RAW_INPUT_DTYPES[self.preprocessing['input_dtype']]
+        if np.issubdtype(dtype, np.integer) and not np.issubdtype(slab.dtype, np.integer):
+            slab = np.rint(slab)
+        return slab[:, None].astype(dtype)
+
+    @staticmethod
+    def resize_slices(stack, size):
+        #* Bilinear resize of N x H x W to N x size. cv2 resizes every channel of an image at once,
+        #* so the slices go in as channels (H x W x N)
+        logger.info(f"Resizing {stack.shape} to {size}")
+        resized = np.empty((len(stack), *size), dtype=stack.dtype)
+        for start in range(0, len(stack), CV_MAX_CHANNELS):
+            chunk = stack[start:start + CV_MAX_CHANNELS]
+            out = cv2.resize(np.ascontiguousarray(chunk.transpose(1, 2, 0)), size[::-1], interpolation=cv2.INTER_LINEAR)
+            resized[start:start + len(chunk)] = out.reshape(*size, len(chunk)).transpose(2, 0, 1)
+        return resized
     
     def remove_bone(self, i, pred):
         # Resize to match prediction/input
         bone_mask = self.bone[self.idx2slice[i]]
         return np.logical_and(pred, bone_mask)   
 
-    def per_slice_inference(self, i):
-        input = self.img[[i]] 
+    def get_batches(self, batch_size=None):
+        #* Split the prepared slices into batches for inference. By default the whole stack goes through in one call,
+        #* unless the model's input is fixed to a batch size of 1, in which case fall back to one slice per call.
+        num_inputs = self.img.shape[0]
+        if not self.supports_batching():
+            logger.info("Model input has a fixed batch size of 1, running inference one slice at a time.")
+            batch_size = 1
+        elif batch_size is None or batch_size <= 0:
+            batch_size = num_inputs
+        logger.info(f"Running inference on {num_inputs} slice(s) in batches of {batch_size}")
+        return [np.arange(i, min(i+batch_size, num_inputs)) for i in range(0, num_inputs, batch_size)]
+
+    def supports_batching(self):
+        #* Batch dimension is a symbolic name (e.g. 'batch_size') or None when dynamic, an int when fixed
+        batch_dim = self.ort_session.get_inputs()[0].shape[0]
+        return not (isinstance(batch_dim, int) and batch_dim == 1)
+
+    def batch_inference(self, idc):
+        input = self.img[idc]
         is_divisible = [x % 2 == 0 for x in input.shape[-2:] ]
         is_too_small = [x < 256 for x in input.shape[-2:]]
-        if not all(is_divisible) or all(is_too_small):
+        resized_in_model = self.preprocessing is not None and self.preprocessing['resize']
+        if not resized_in_model and (not all(is_divisible) or all(is_too_small)):
             #TODO Resampling will affect measurements, if new pixel size not used for calc.
             logger.error(f"Issues with input shape: {input.shape}, resampling not yet implemented.")
             return None, None, None
             #input = resize(input, (512, 512), mode='bicubic')
-        prediction = self.inference(input)
+        predictions = self.inference(input)
 
-        logger.info(f"Updating holders (shape: {prediction.shape}) into compartments.")
+        logger.info(f"Updating holders with {len(predictions)} prediction(s) into compartments.")
 
-        for compartment, channel in self.segment_dict.items():
-            pred = prediction[channel]
-            self.holders[compartment][self.idx2slice[i]] = self.remove_bone(i, pred) if self.bone is not None else pred
+        for i, prediction in zip(idc, predictions):
+            for compartment, channel in self.segment_dict.items():
+                pred = prediction[channel]
+                self.holders[compartment][self.idx2slice[i]] = self.remove_bone(i, pred) if self.bone is not None else pred
 
     def inference(self, img):
         #* Forward pass through the model
         t= time.time()
         ort_inputs = {self.ort_session.get_inputs()[0].name: \
-            img.astype(np.float32)}
+            img if self.preprocessing is not None else img.astype(np.float32)}
         logger.info(f'Model load time (s): {np.round(time.time() - t, 7)}')
         #* Inference
         t= time.time()
-        outputs = np.array(self.ort_session.run(None, ort_inputs)[0])
-        outputs = np.squeeze(outputs)
+        outputs = np.array(self.ort_session.run(None, ort_inputs)[0]) # Batch x Channels x H x W
         logger.info(f'Inference time (s): {np.round(time.time() - t, 7)}')
         logger.info(f"Model outputs: {outputs.shape}")
 
-        if outputs.shape[0] > 1:
-            logger.info("Multiple channels detected, applying softmax")
-            pred = np.argmax(softmax(outputs, axis=0), axis=0).astype(np.int8) # Argmax then one-hot encode
-            preds = [np.where(pred == val, 1, 0) for val in np.unique(pred)] # one-hot encode
-            return np.stack(preds)
-        else:
-            logger.info("Single channel detected, applying sigmoid")
-            return np.round(self.sigmoid(outputs)).astype(np.int8)
+        return self.logits_to_masks(outputs)
+
+    logits_to_masks = staticmethod(masks.logits_to_masks) # See abcTK/segment/masks.py
 
     def post_process(self, mask_dir, refImage, originalImage, compartment, **kwargs):
         output_mask_dir = os.path.join(mask_dir, self.v_level)
@@ -438,7 +587,8 @@ class segmentationEngine():
         else:
             is_edit = False
 
-        writer = sanityWriter(self.output_dir, self.v_level, self.slice_number, self.num_slices, self.settings['window'], self.settings['level'], self.modality, is_edit)
+        writer = sanityWriter(self.output_dir, self.v_level, self.slice_number, self.num_slices, self.settings['window'], self.settings['level'], self.modality, is_edit,
+                              slice_offset=self.slice_offset)
 
         data = {}
         paths_to_sanity = {}
@@ -446,41 +596,48 @@ class segmentationEngine():
             compartments = self.segments
         else:
             compartments = [compartment]
+        merge_masks = compartment is not None # Keep the other compartments already in the multi-label mask
 
+        #* Compartments in the order they're reported, IMAT goes before the skeletal_muscle it's removed from
+        report = []
         for compartment in compartments:
-            logger.info(f"Analysing compartment: {compartment}")
-            
             if compartment == 'background': continue # Skip background
 
             if compartment == 'skeletal_muscle' and 'IMAT' not in self.segments and self.modality != 'CBCT':
                     if not all([x is None for x in self.thresholds['IMAT']]):
-                        logger.info("Extracting IMAT stats")
-                        data['IMAT'] = self.extract_stats(self.holders['IMAT'], self.thresholds['IMAT'])
-
-                        logger.info("Writing IMAT sanity check")
-                        paths_to_sanity['IMAT'] = writer.write_segmentation_sanity('IMAT', self.image, self.holders['IMAT'])
-                        #* Convert predictions back to ITK Image, using input Image as reference
-                        logger.info(f"Converting IMAT mask to ITK Image. Size: {self.holders['IMAT'].shape}")
-                        IMAT  = self.npy2itk(self.holders['IMAT'] , refImage)
-                        logger.info("Writing IMAT mask")
-                        self.save_prediction(output_mask_dir, 'IMAT', IMAT, originalImage)
-
-                        logger.info("Removing IMAT from skeletal_muscle")
-                        self.holders['skeletal_muscle'] = np.where(self.holders['IMAT'] == 1, 0, self.holders['skeletal_muscle']).astype(np.int8)
+                        report.append('IMAT')
                     else:
                         logger.warning("NOT CALCULATING IMAT - NO FAT THRESHOLDS PROVIDED.")
-            
-            data[compartment] = self.extract_stats(self.holders[compartment], self.thresholds[compartment])
+            report.append(compartment)
+
+        if 'IMAT' in report:
+            logger.info("Removing IMAT from skeletal_muscle")
+            self.holders['skeletal_muscle'].data[self.holders['IMAT'].data == 1] = 0 # Same slab
+
+        logger.info(f"Extracting stats for: {report}")
+        stats = self.extract_stats({x: self.holders[x] for x in report}, {x: self.thresholds[x] for x in report})
+
+        Masks = {} # Compartments for the multi-label mask, see abcTK/segment/mask_store.py
+        for compartment in report:
+            logger.info(f"Analysing compartment: {compartment}")
+            data[compartment] = stats[compartment]
             logger.info(f"Writing {compartment} sanity check")
             paths_to_sanity[compartment] =writer.write_segmentation_sanity(compartment, self.image, self.holders[compartment])
             logger.info(f"Converting {compartment} to ITK Image. Size: {self.holders[compartment].shape}")
-            SkeletalMuscle = self.npy2itk(self.holders[compartment], refImage)
-            logger.info(f"Writing {compartment} mask")
-            self.save_prediction(output_mask_dir, compartment, SkeletalMuscle, originalImage)
+            SkeletalMuscle = self.to_output_grid(self.npy2itk(self.holders[compartment], refImage), originalImage)
+            if mask_store.writes_nifti():
+                logger.info(f"Writing {compartment} mask")
+                self.save_prediction(output_mask_dir, compartment, SkeletalMuscle)
+            if mask_store.writes_multilabel():
+                Masks[compartment] = SkeletalMuscle
+
+        if Masks:
+            logger.info(f"Writing multi-label mask: {list(Masks.keys())}")
+            mask_store.write(output_mask_dir, Masks, merge=merge_masks)
         
         if 'override_spine_sanity' in kwargs:
-            json = {self.v_level: [0, 0, self.slice_number]}
-            paths_to_sanity['SPINE'] = writer.write_spine_sanity('SPINE', originalImage, json, self.loader_function)
+            json = {self.v_level: [0, 0, self.slice_number + self.slice_offset]}
+            paths_to_sanity['SPINE'] = writer.write_spine_sanity('SPINE', self.get_full_image(originalImage), json, self.loader_function)
         else:
             ## Plot every labelled level, if a spine prediction is available, so the target
             ## level's position is shown against the whole spine - otherwise (not labelled yet)
@@ -497,58 +654,85 @@ class segmentationEngine():
             if spine_entry is None and 'reference_scan' in kwargs:
                 spine_entry = database.spine.find_one({"_id": kwargs['reference_scan']}, {"prediction": 1})
 
-            if spine_entry is not None:
-                paths_to_sanity['SPINE'] = writer.write_spine_sanity('SPINE', originalImage, spine_entry['prediction'], self.loader_function)
+            spine_sanity = os.path.join(self.output_dir, 'sanity', 'SPINE' + sanityWriter.extension) # Written by abcTK/inference/spine.py
+            if self.reference_geometry is not None and spine_entry is not None and os.path.isfile(spine_sanity):
+                ## Slab/cache: re-use the spine job's image rather than rebuilding the whole volume for a MIP
+                logger.info(f"Full volume not loaded, re-using spine labelling sanity image: {spine_sanity}")
+                paths_to_sanity['SPINE'] = {self.v_level: spine_sanity}
+            elif spine_entry is not None:
+                paths_to_sanity['SPINE'] = writer.write_spine_sanity('SPINE', self.get_full_image(originalImage), spine_entry['prediction'], self.loader_function)
             else:
-                json = {self.v_level: [0, 0, self.slice_number]}
-                paths_to_sanity['SPINE'] = writer.write_spine_sanity('SPINE', originalImage, json, self.loader_function)
+                json = {self.v_level: [0, 0, self.slice_number + self.slice_offset]}
+                paths_to_sanity['SPINE'] = writer.write_spine_sanity('SPINE', self.get_full_image(originalImage), json, self.loader_function)
 
         paths_to_sanity['ALL'] = writer.write_all_segmentation_sanity('ALL', self.image, self.holders, data)
         return data, paths_to_sanity
 
-    def extract_stats(self, mask, thresholds):
-        #* Extract region of interest
-        prediction = mask[self.slice_number-self.num_slices:self.slice_number+self.num_slices+1]
-        image = self.image[self.slice_number-self.num_slices:self.slice_number+self.num_slices+1]
+    def extract_stats(self, masks, thresholds):
+        #* Per-slice area and mean density of every compartment at once. masks/thresholds: {compartment: ...}
+        slices = np.arange(int(self.slice_number)-self.num_slices, int(self.slice_number)+self.num_slices+1)
+        rows = slice(slices[0], slices[-1]+1)
+        image = self.image[rows]
         logger.info(f"Extracting stats from sub-volume with shape: {image.shape}")
-        logger.info(f"Applying thresholds: {thresholds}")
-        #* Apply thresholding
-        threshold_image = self.threshold_mask(image, thresholds)
-        prediction = np.logical_and(threshold_image, prediction).astype(np.int8)
+
+        #* Thresholded masks, compartments x slices x H x W. Each threshold range is only applied once
+        compartments = list(masks.keys())
+        in_range = {}
+        selected = np.empty((len(compartments), *image.shape), dtype=bool)
+        for c, compartment in enumerate(compartments):
+            key = tuple(thresholds[compartment])
+            if key not in in_range:
+                logger.info(f"Applying thresholds: {key}")
+                in_range[key] = self.threshold_mask(image, key).astype(bool)
+            np.logical_and(in_range[key], masks[compartment][rows], out=selected[c])
 
         #* Calculate stats across subset
+        selected = selected.reshape(len(compartments), image.shape[0], -1)
+        areas = selected.sum(axis=-1)
+        totals = np.einsum('csp,sp->cs', selected, image.reshape(image.shape[0], -1).astype(np.float64))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            densities = totals / areas # nan where the compartment is absent, as np.mean of nothing
+
         stats = {}
-        slice_numbers = [x for x in np.arange(self.slice_number-self.num_slices, self.slice_number+self.num_slices+1) ]
-
-        for idx, slice_num in zip(range(image.shape[0]), slice_numbers) :
-            im, pred = image[idx], prediction[idx]
-            #* Area calculation          
-            area = float(np.sum(pred))
-            #* Density calculation
-            density = float(np.mean(im[pred==1]))
-            stats[f'Slice {slice_num}'] = {'area (voxels)': area, 'density (HU)': density}
-        
+        for c, compartment in enumerate(compartments):
+            stats[compartment] = {f'Slice {slice_num + self.slice_offset}': {'area (voxels)': float(areas[c, idx]), 'density (HU)': float(densities[c, idx])}
+                                  for idx, slice_num in enumerate(slices[:image.shape[0]])}
         return stats
 
     def extract_imat(self, numpyImage):
         # Extract IMAT from muscle segmentation: fatByThreshold U muscleSegmentation
         logger.info(f"Generating IMAT mask using thresholds: {self.thresholds['IMAT']}")
 
-        #TODO Make this faster!! This seems to be relatively slow (~1sec)
-        blurred_image = self.convolve_gaussian(numpyImage, axis=None, sigma=0.5)
+        muscle = self.holders['skeletal_muscle']
+        self.holders['IMAT'] = SlabHolder(muscle.shape, muscle.start, muscle.stop)
+        muscle_slices = np.flatnonzero(muscle.data.any(axis=(1, 2))) + muscle.start
+        if len(muscle_slices) == 0:
+            return
+        
+        #* IMAT is only non-zero where there's muscle: blur the slices with muscle, plus enough either side
+        #* for the kernel to reach (same result as blurring the whole volume)
+        first, last = muscle_slices[0], muscle_slices[-1] + 1
+        margin = len(self.gaussian_taps(0.5)) // 2
+        start, stop = max(first - margin, 0), min(last + margin, numpyImage.shape[0])
+        blurred_image = self.convolve_gaussian_separable(numpyImage[start:stop], sigma=0.5)[first-start:last-start]
         fat_threshold = self.threshold_mask(blurred_image, self.thresholds['IMAT'])
         
-        IMAT = np.logical_and(fat_threshold, self.holders['skeletal_muscle']).astype(np.int8)
-        connected_components = skimage.measure.label(IMAT, connectivity=2, return_num=False) # connected components
-        # Each component is assigned a diff. label so need to cast to 1
-        self.holders['IMAT'] = np.where(connected_components != 0, 1, 0)
+        self.holders['IMAT'][first:last] = np.logical_and(fat_threshold, muscle[first:last])
+
+    def to_output_grid(self, Prediction, origImage):
+        # Prediction on origImage's grid, or the full volume's if only a slab was loaded
+        geometry = self.reference_geometry if self.reference_geometry is not None else self.get_geometry(origImage)
+        mapping = self.grid_mapping(Prediction, geometry)
+        if mapping is not None:
+            #* Same voxels up to axis order/flips (e.g. the LPS reorientation in load_data) - just re-index
+            Prediction = self.remap_to_geometry(sitk.GetArrayViewFromImage(Prediction).astype(np.uint8), mapping, geometry)
+        else:
+            Prediction = self.resample_to_geometry(Prediction, geometry, sitk.sitkNearestNeighbor, sitk.sitkUInt8)
+        return Prediction
 
-    def save_prediction(self, output_dir, tag, Prediction, origImage):
-        #* Save mask to outputs folder
+    def save_prediction(self, output_dir, tag, Prediction):
+        #* Save mask (already on the output grid, see to_output_grid) to outputs folder
         output_filename = os.path.join(output_dir, tag + '.nii.gz')
-        
-        # Resample Prediction to origImage
-        Prediction = sitk.Resample(Prediction, origImage, sitk.Transform(), sitk.sitkLinear, 0, origImage.GetPixelID())
         logger.info(f"Saving prediction with shape {Prediction.GetSize()} to: {output_filename}")
 
         sitk.WriteImage(Prediction, output_filename)
@@ -572,10 +756,11 @@ class segmentationEngine():
     ############################################################
     @staticmethod
     def wl_norm(img, window, level):
+        #* img: a slice or a stack of slices (window/level from each slice if not given)
         if window is None:
-            window = img.max()-img.min()
+            window = img.max(axis=(-2, -1), keepdims=True)-img.min(axis=(-2, -1), keepdims=True)
         if level is None:
-            level = img.mean()
+            level = img.mean(axis=(-2, -1), keepdims=True)
         minval = level - window/2
         maxval = level + window/2
         wld = np.clip(img, minval, maxval)
@@ -583,17 +768,12 @@ class segmentationEngine():
         wld /= window
         return wld
 
-    @staticmethod
-    def expand(img):
-        #* Convert to 3 channels
-        return np.repeat(img[..., None], 3, axis=-1)
-    
-    @staticmethod
-    def npy2itk(npy, reference):
-        #* npy array to itk image with information from reference
-        Image = sitk.GetImageFromArray(npy)
-        Image.CopyInformation(reference)
-        return Image
+    #* Moving images/masks between grids, see abcTK/segment/masks.py
+    npy2itk = staticmethod(masks.npy2itk)
+    get_geometry = staticmethod(masks.get_geometry)
+    resample_to_geometry = staticmethod(masks.resample_to_geometry)
+    grid_mapping = staticmethod(masks.grid_mapping)
+    remap_to_geometry = staticmethod(masks.remap_to_geometry)
 
     @staticmethod
     def reorient(Image, orientation='LPS'):
@@ -602,16 +782,33 @@ class segmentationEngine():
         return orient.Execute(Image), orient
 
     @staticmethod
-    def convolve_gaussian(image, axis=-1, sigma=3):
-        #* Convolve image with 1D gaussian  
+    def gaussian_taps(sigma):
+        #* 1D gaussian, the kernel along each axis
         t = np.linspace(-10, 10, 30)
         eps = 1e-24
         gauss = np.exp(-t**2 / (2 * (sigma + eps)**2))
         gauss /= np.trapz(gauss)  # normalize the integral to 1
+        return gauss
+
+    @staticmethod
+    def convolve_gaussian(image, axis=-1, sigma=3):
+        #* Convolve image with 1D gaussian  
+        gauss = segmentationEngine.gaussian_taps(sigma)
         kernel = gauss[None, None, :]*gauss[:, None, None]*gauss[None, :, None]
         logger.info(f"Kernel size: {kernel.shape}")
         return signal.fftconvolve(image, kernel, mode='same', axes=axis)
 
+    @staticmethod
+    def convolve_gaussian_separable(image, sigma=3):
+        #* Same as convolve_gaussian over all axes, one 1D pass per axis. Zero padding and
+        #* (for an even number of taps) the origin shift match fftconvolve's 'same' output.
+        gauss = segmentationEngine.gaussian_taps(sigma)
+        origin = -1 if len(gauss) % 2 == 0 else 0
+        blurred = np.asarray(image, dtype=np.float64)
+        for axis in range(blurred.ndim):
+            blurred = convolve1d(blurred, gauss, axis=axis, mode='constant', cval=0.0, origin=origin)
+        return blurred
+
     @staticmethod
     def get_mask_loader_function(path):
         # Accepts numpy and nifty masks.
@@ -819,53 +1016,25 @@ class segmentationEngine():
            raise abort(400, {'message': f'Model for {self.v_level} not implemented yet.'})
 
     def _get_window_level(self):
-        #~ Query settings for specific models (window/level)
-        settings_bank = {
-            'C3': {
-                'CT': {'window': 400, 'level': 50}, 
-                'CBCT': {'window': 400, 'level': 50}
-                },
-            'T4': {
-                'CT': {'window': 400, 'level': 50}
-                },
-            'T9': {
-                'CT': {'window': 400, 'level': 50}
-                },
-            'T12': {
-                'CT': {'window': 400, 'level': 50},
-                'LowDoseCT': {'window': 400, 'level':50}
-                },
-            'L3': {
-                'CT': {'window': 400, 'level': 50}
-                },
-            'L5': {
-                'CT': {'window': 400, 'level': 50}
-                },
-            'Sacrum': {
-                'MR': {'window': 2693, 'level': 307} # Range and mean of training set
-                },
-            'Thigh': {
-                'CT': {'window': 400, 'level': 50}
-                }
-        }
-
-        if self.v_level in settings_bank:
-            if self.modality in settings_bank[self.v_level]:
-                return settings_bank[self.v_level][self.modality]
-            else:
-                # Bad request since wrong modality
-                raise abort(400, {'message': f'No {self.modality} model for {self.v_level}.'}) 
-        else:
-            # Bad request since wrong level
-            raise abort(400, {'message': f'Model for {self.v_level} not implemented yet.'})
-
-    def _set_options(self):
-        #* Inference options
-        self.sess_options = ort.SessionOptions()
-        self.sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
-        self.sess_options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL  # ! or ORT_PARALLEL
-        self.sess_options.log_severity_level = 4
-        self.sess_options.enable_profiling = False
-        self.sess_options.inter_op_num_threads = os.cpu_count() - 1
-        self.sess_options.intra_op_num_threads = os.cpu_count() - 1
+        #~ Window/level the model was trained with, from the model bank (None -> from each slice)
+        model = self.model_paths[self.modality]
+        return {'window': model.get('window'), 'level': model.get('level')}
+
+    def _get_model_preprocessing(self):
+        #~ Pre-processing folded into the model by prepare_model.py, if any
+        metadata = self.ort_session.get_modelmeta().custom_metadata_map
+        if PREPROCESSING_KEY not in metadata:
+            return None
+        preprocessing = json.loads(metadata[PREPROCESSING_KEY])
+        settings = self._get_window_level()
+        if (preprocessing['window'], preprocessing['level']) != (settings['window'], settings['level']):
+            logger.warning(f"Model was prepared with window/level {preprocessing['window']}/{preprocessing['level']}, "
+                           f"model bank has {settings['window']}/{settings['level']}. Using the model's.")
+        return preprocessing
+
+    def _set_options(self, **kwargs):
+        #* Inference options - worker defaults (see abcTK/wrapper.py) overridden by any `ort_*` request args
+        #* e.g. ort_intra_op_num_threads, ort_graph_optimization_level, ort_providers
+        overrides = {k[len('ort_'):]: v for k, v in kwargs.items() if k.startswith('ort_')}
+        return resolve_session_config(overrides)
 
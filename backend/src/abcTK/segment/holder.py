@@ -0,0 +1,81 @@
+"""
+Prediction holder that only stores the slices being segmented. Indexed with full-volume slice numbers
+like the full-size array it replaces; slices outside the slab read as zeros.
+"""
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class SlabHolder():
+    def __init__(self, shape, start, stop, dtype=np.int8):
+        #* shape: full volume (slices x H x W). Stores slices [start, stop)
+        self.shape = tuple(shape)
+        self.start = max(int(start), 0)
+        self.stop = min(int(stop), self.shape[0])
+        self.data = np.zeros((max(self.stop - self.start, 0), *self.shape[1:]), dtype=dtype)
+
+    @classmethod
+    def from_array(cls, array):
+        #* Crop a full-volume mask to its non-zero slices
+        array = np.asarray(array)
+        nonzero = np.flatnonzero(array.any(axis=tuple(range(1, array.ndim))))
+        start, stop = (nonzero[0], nonzero[-1] + 1) if len(nonzero) else (0, 0)
+        holder = cls(array.shape, start, stop, dtype=array.dtype)
+        holder.data[:] = array[holder.start:holder.stop]
+        return holder
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    def _slab_index(self, key):
+        #* Full-volume slice index/range -> (slab index, rest of the key, in_slab)
+        z, rest = (key[0], key[1:]) if isinstance(key, tuple) else (key, ())
+        if isinstance(z, slice):
+            start, stop, step = z.indices(self.shape[0])
+            if step != 1:
+                raise IndexError("SlabHolder only supports contiguous slice ranges")
+            stop = max(stop, start)
+            return (start, stop), rest, self.start <= start and stop <= self.stop
+        z = int(z) + self.shape[0] if z < 0 else int(z)
+        return z, rest, self.start <= z < self.stop
+
+    def __getitem__(self, key):
+        z, rest, in_slab = self._slab_index(key)
+        if isinstance(z, tuple):
+            start, stop = z
+            if in_slab:
+                return self.data[(slice(start - self.start, stop - self.start), *rest)] # View
+            out = np.zeros((stop - start, *self.shape[1:]), dtype=self.dtype)
+            lo, hi = max(start, self.start), min(stop, self.stop)
+            if lo < hi:
+                out[lo - start:hi - start] = self.data[lo - self.start:hi - self.start]
+            return out[(slice(None), *rest)]
+        if in_slab:
+            return self.data[(z - self.start, *rest)]
+        return np.zeros(self.shape[1:], dtype=self.dtype)[rest]
+
+    def __setitem__(self, key, value):
+        z, rest, in_slab = self._slab_index(key)
+        if not in_slab:
+            raise IndexError(f"Slice(s) {z} outside the stored slab [{self.start}, {self.stop})")
+        if isinstance(z, tuple):
+            self.data[(slice(z[0] - self.start, z[1] - self.start), *rest)] = value
+        else:
+            self.data[(z - self.start, *rest)] = value
+
+    def to_full(self):
+        #* Full-volume array, e.g. to write the mask with npy2itk
+        full = np.zeros(self.shape, dtype=self.dtype)
+        full[self.start:self.stop] = self.data
+        return full
+
+    def __array__(self, dtype=None):
+        full = self.to_full()
+        return full if dtype is None else full.astype(dtype)
+
+    def __repr__(self):
+        return f"SlabHolder(shape={self.shape}, slices=[{self.start}, {self.stop}), dtype={self.dtype})"
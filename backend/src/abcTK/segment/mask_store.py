@@ -0,0 +1,115 @@
+"""
+Multi-label mask output: every compartment of a level in one uint8 volume (masks/<level>/labels.nii.gz),
+one bit per compartment, cropped to the bounding box of the non-empty voxels. labels.json holds the
+bit of each compartment and the full grid the crop is taken from, so masks can be restored onto it.
+"""
+import os
+import json
+import logging
+
+import numpy as np
+import SimpleITK as sitk
+
+logger = logging.getLogger(__name__)
+
+#* 'nifti' (one .nii.gz per compartment), 'multilabel' (labels.nii.gz only) or 'both'
+MASK_FORMAT = os.environ.get('MASK_OUTPUT_FORMAT', 'nifti')
+MASK_CROP = os.environ.get('MASK_OUTPUT_CROP', 'true').lower() in ['true', '1', 'yes']
+COMPRESSION_LEVEL = 1 # zlib, most of the size reduction for a fraction of the time of the default
+
+LABELS_FILENAME = 'labels.nii.gz'
+META_FILENAME = 'labels.json'
+MAX_LABELS = 8 # Bits in uint8
+
+
+def writes_nifti():
+    return MASK_FORMAT in ['nifti', 'both']
+
+
+def writes_multilabel():
+    return MASK_FORMAT in ['multilabel', 'both']
+
+
+def has_labels(level_dir):
+    return os.path.isfile(os.path.join(level_dir, META_FILENAME))
+
+
+def write(level_dir, Masks, merge=False, crop=MASK_CROP):
+    #* Masks: {compartment: binary sitk.Image}, all on the same grid. merge: keep the other compartments already stored
+    labels, array, geometry = {}, None, None
+    if merge and has_labels(level_dir):
+        labels, array, geometry = _read_array(level_dir)
+
+    for name, Mask in Masks.items():
+        mask = sitk.GetArrayViewFromImage(Mask)
+        if geometry is None:
+            geometry = _get_geometry(Mask)
+            array = np.zeros(mask.shape, dtype=np.uint8)
+        elif mask.shape != array.shape:
+            raise ValueError(f"{name} mask ({mask.shape}) is not on the stored grid ({array.shape})")
+        if name not in labels:
+            free = sorted(set(range(MAX_LABELS)) - set(labels.values()))
+            if not free:
+                raise ValueError(f"No room for {name}, at most {MAX_LABELS} compartments can be stored")
+            labels[name] = free[0]
+        bit = np.uint8(1 << labels[name])
+        array &= ~bit
+        array[mask > 0] |= bit
+
+    #* Crop to the non-empty voxels
+    start = [0, 0, 0]
+    if crop:
+        nonzero = np.nonzero(array)
+        if len(nonzero[0]):
+            start = [int(x.min()) for x in nonzero]
+            array = array[tuple(slice(lo, int(x.max()) + 1) for lo, x in zip(start, nonzero))]
+        else:
+            array = array[:1, :1, :1] # Nothing segmented, an empty volume can't be written
+
+    Labels = sitk.GetImageFromArray(np.ascontiguousarray(array))
+    Labels.SetSpacing(geometry['spacing'])
+    Labels.SetDirection(geometry['direction'])
+    Labels.SetOrigin(_index_to_physical(geometry, start[::-1]))
+
+    os.makedirs(level_dir, exist_ok=True)
+    output_filename = os.path.join(level_dir, LABELS_FILENAME)
+    logger.info(f"Saving {list(labels.keys())} with shape {Labels.GetSize()} (cropped from {geometry['size']}) to: {output_filename}")
+    sitk.WriteImage(Labels, output_filename, True, COMPRESSION_LEVEL)
+    with open(os.path.join(level_dir, META_FILENAME), 'w') as f:
+        json.dump({'labels': labels, 'start': start[::-1], **geometry}, f)
+
+
+def read(level_dir, names=None):
+    #* {compartment: uint8 sitk.Image on the full grid} for the compartments in names (default: all)
+    labels, array, geometry = _read_array(level_dir)
+    names = list(labels.keys()) if names is None else [x for x in names if x in labels]
+    Masks = {}
+    for name in names:
+        Mask = sitk.GetImageFromArray(((array >> labels[name]) & 1).astype(np.uint8))
+        Mask.SetOrigin(geometry['origin'])
+        Mask.SetSpacing(geometry['spacing'])
+        Mask.SetDirection(geometry['direction'])
+        Masks[name] = Mask
+    return Masks
+
+
+def _read_array(level_dir):
+    #* Stored labels expanded to the full grid (z, y, x)
+    with open(os.path.join(level_dir, META_FILENAME), 'r') as f:
+        meta = json.load(f)
+    geometry = {x: meta[x] for x in ['origin', 'spacing', 'direction', 'size']}
+    array = np.zeros(meta['size'][::-1], dtype=np.uint8)
+    cropped = sitk.GetArrayFromImage(sitk.ReadImage(os.path.join(level_dir, LABELS_FILENAME)))
+    start = meta['start'][::-1]
+    array[tuple(slice(lo, lo + n) for lo, n in zip(start, cropped.shape))] = cropped
+    return meta['labels'], array, geometry
+
+
+def _get_geometry(Image):
+    return {'origin': list(Image.GetOrigin()), 'spacing': list(Image.GetSpacing()),
+            'direction': list(Image.GetDirection()), 'size': list(Image.GetSize())}
+
+
+def _index_to_physical(geometry, index):
+    direction = np.array(geometry['direction']).reshape(3, 3)
+    return tuple(float(x) for x in np.array(geometry['origin']) + direction @ (np.array(geometry['spacing']) * np.array(index)))
@@ -0,0 +1,84 @@
+"""
+Mask helpers that only need numpy and SimpleITK: model logits to masks, and moving images and masks between
+grids, re-indexing instead of resampling when the grids only differ by axis order/flips.
+"""
+import logging
+
+import numpy as np
+import SimpleITK as sitk
+
+logger = logging.getLogger(__name__)
+
+
+def logits_to_masks(outputs):
+    #* Logits (Batch x Channels x H x W) -> uint8 masks, same shape. Channel i is always class i,
+    #* whether or not that class is present, so segment_dict channels can index it directly.
+    if outputs.shape[1] > 1:
+        logger.info("Multiple channels detected, taking argmax of the logits")
+        #* Softmax is monotonic, argmax of the logits gives the same labels
+        pred = np.argmax(outputs, axis=1)[:, None] # Batch x 1 x H x W
+        channels = np.arange(outputs.shape[1]).reshape(1, -1, 1, 1)
+        return (pred == channels).view(np.uint8)
+    else:
+        logger.info("Single channel detected, thresholding at sigmoid(x) > 0.5")
+        return (outputs > 0).view(np.uint8) # sigmoid(x) > 0.5 <=> x > 0
+
+
+def npy2itk(npy, reference):
+    #* npy array (or SlabHolder, expanded to the full volume) to itk image with information from reference (an image or a geometry dict)
+    Image = sitk.GetImageFromArray(np.asarray(npy))
+    if isinstance(reference, dict):
+        Image.SetOrigin(reference['origin'])
+        Image.SetSpacing(reference['spacing'])
+        Image.SetDirection(reference['direction'])
+    else:
+        Image.CopyInformation(reference)
+    return Image
+
+
+def get_geometry(Image):
+    return {'origin': Image.GetOrigin(), 'direction': Image.GetDirection(), 'size': Image.GetSize(), 'spacing': Image.GetSpacing()}
+
+
+def resample_to_geometry(Image, geometry, interpolator=sitk.sitkNearestNeighbor, pixel_id=None):
+    #* Resample onto a grid given as origin/direction/size/spacing (e.g. LoadedVolume.geometry)
+    pixel_id = Image.GetPixelID() if pixel_id is None else pixel_id
+    return sitk.Resample(Image, [int(x) for x in geometry['size']], sitk.Transform(), interpolator,
+                         geometry['origin'], geometry['spacing'], geometry['direction'], 0, pixel_id)
+
+
+def grid_mapping(Image, geometry, tol=1e-3):
+    #* If Image's voxel centres lie on geometry's grid, returns (axes, signs, offsets) such that along each
+    #* axis j of geometry (x, y, z): Image index[axes[j]] = signs[j] * index[j] + offsets[j]. Otherwise None
+    spacing, direction = np.array(Image.GetSpacing()), np.array(Image.GetDirection()).reshape(3, 3)
+    index_from_physical = np.linalg.inv(direction @ np.diag(spacing))
+    M = index_from_physical @ np.array(geometry['direction']).reshape(3, 3) @ np.diag(geometry['spacing'])
+    offsets = index_from_physical @ (np.array(geometry['origin']) - np.array(Image.GetOrigin()))
+    R = np.rint(M)
+    if not np.allclose(M, R, atol=tol) or not np.allclose(offsets, np.rint(offsets), atol=tol):
+        return None
+    if not ((np.abs(R).sum(axis=0) == 1).all() and (np.abs(R).sum(axis=1) == 1).all()):
+        return None # Scaled/sheared, not a signed permutation
+    axes = np.abs(R).argmax(axis=0)
+    signs = R[axes, np.arange(3)].astype(int)
+    return axes, signs, np.rint(offsets[axes]).astype(int)
+
+
+def remap_to_geometry(array, mapping, geometry):
+    #* array: (z, y, x) on the grid grid_mapping was given, re-indexed onto geometry (zeros outside it)
+    axes, signs, offsets = mapping
+    source = np.transpose(array.T, axes) # x, y, z in geometry's axis order
+    size = [int(x) for x in geometry['size']]
+    out = np.zeros(size, dtype=array.dtype)
+    src_index, out_index = [], []
+    for j in range(3):
+        offset = offsets[j]
+        if signs[j] < 0:
+            source = np.flip(source, axis=j)
+            offset = source.shape[j] - 1 - offset
+        lo, hi = max(0, -offset), min(size[j], source.shape[j] - offset)
+        hi = max(lo, hi)
+        out_index.append(slice(lo, hi))
+        src_index.append(slice(lo + offset, hi + offset))
+    out[tuple(out_index)] = source[tuple(src_index)]
+    return npy2itk(np.ascontiguousarray(out.T), geometry)
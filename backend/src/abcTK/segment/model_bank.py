@@ -1,48 +1,57 @@
 """
 MODEL BANK
+Each model: path to the ONNX file, output channel of each segment and the window/level
+its input slices are normalised with (see abcTK/segment/prepare_model.py to fold that into the graph).
 """
 
 model_bank = {
     'C3': {'CT':
             {'path': '/models/segmentation/TitanMixNet-Med-C3-Body-M.onnx',
-            'segments': {'background': 0, 'skeletal_muscle': 1, 'body': 2}
+            'segments': {'background': 0, 'skeletal_muscle': 1, 'body': 2},
+            'window': 400, 'level': 50
             },
         'CBCT':
             {'path': '/models/segmentation/TitanMixNet-Med-CBCT-C3-Body-M.onnx',
-            'segments': {'background': 0, 'skeletal_muscle': 1, 'body': 2}
+            'segments': {'background': 0, 'skeletal_muscle': 1, 'body': 2},
+            'window': 400, 'level': 50
             }
     },
     'T4': {'CT':
             {'path': '/models/segmentation/TitanMixNet-Med-T4-Body-M.onnx',
-            'segments': {'background': 0, 'skeletal_muscle': 1, 'body': 2}
+            'segments': {'background': 0, 'skeletal_muscle': 1, 'body': 2},
+            'window': 400, 'level': 50
             }
     },
     'T9': {'CT':
             {'path': '/models/segmentation/TitanMixNet-Med-T9-Body-M.onnx',
-            'segments': {'background': 0, 'skeletal_muscle': 1, 'body': 2}
+            'segments': {'background': 0, 'skeletal_muscle': 1, 'body': 2},
+            'window': 400, 'level': 50
             }
     },
-    'T12': {'CT': {'path': '/models/segmentation/TitanMixNet-Med-T12-Body-M.onnx','segments': {'background': 0, 'skeletal_muscle': 1, 'body': 2}},
-            'LowDoseCT': {'path': '/models/segmentation/NLST-T12-M.onnx','segments': {'background': 0, 'skeletal_muscle': 1}}
+    'T12': {'CT': {'path': '/models/segmentation/TitanMixNet-Med-T12-Body-M.onnx','segments': {'background': 0, 'skeletal_muscle': 1, 'body': 2}, 'window': 400, 'level': 50},
+            'LowDoseCT': {'path': '/models/segmentation/NLST-T12-M.onnx','segments': {'background': 0, 'skeletal_muscle': 1}, 'window': 400, 'level': 50}
             },
     'L3': {'CT': 
             {'path': '/models/segmentation/TitanMixNet-Med-L3-FM-with-STAMPEDE-edits.onnx',
-            'segments': {'background': 0, 'skeletal_muscle': 1, 'subcutaneous_fat': 2, 'visceral_fat': 3}
+            'segments': {'background': 0, 'skeletal_muscle': 1, 'subcutaneous_fat': 2, 'visceral_fat': 3},
+            'window': 400, 'level': 50
             }
     },
     'L5': {'CT': 
             {'path': '/models/segmentation/TitanMixNet-Med-L5-FM.onnx',
-            'segments': {'background': 0, 'skeletal_muscle': 1, 'subcutaneous_fat': 2, 'visceral_fat': 3}
+            'segments': {'background': 0, 'skeletal_muscle': 1, 'subcutaneous_fat': 2, 'visceral_fat': 3},
+            'window': 400, 'level': 50
             }
     },
     'Sacrum': {'MR': 
                 {'path': '/models/segmentation/TitanMixNet-Med-Pelvis-SFM-MRI.onnx',
-                    'segments': {'background': 0, 'skeletal_muscle': 1, 'subcutaneous_fat': 2}
+                    'segments': {'background': 0, 'skeletal_muscle': 1, 'subcutaneous_fat': 2},
+                    'window': 2693, 'level': 307 # Range and mean of training set
                 }               
     },
     'Thigh': {'CT':
                 {'path': '/models/segmentation/Thigh_14pats.quant.onnx',
-                'segments': {'background': 0, 'skeletal_muscle': 1} }
+                'segments': {'background': 0, 'skeletal_muscle': 1}, 'window': 400, 'level': 50}
             }
 }
 
@@ -0,0 +1,133 @@
+"""
+Prepares a segmentation model so that it takes raw slices: window/level, (optionally) resizing to the
+model's input size, replication to 3 channels and ImageNet normalisation are prepended to the ONNX graph.
+The prepared model's input is N x 1 x H x W (int16 by default) and segmentationEngine passes the slices
+straight through (the settings are stored in the model's metadata, under PREPROCESSING_KEY).
+
+Usage:
+    python -m abcTK.segment.prepare_model L3 CT [-o output.onnx] [--no-resize] [--input-dtype float32]
+    python -m abcTK.segment.prepare_model --all
+
+Then point the model's 'path' in abcTK/segment/model_bank.py at the prepared file.
+"""
+import os
+import json
+import logging
+import argparse
+
+import numpy as np
+import onnx
+from onnx import helper, numpy_helper, TensorProto
+
+from abcTK.segment.model_bank import model_bank
+from abcTK.segment.engine import INPUT_SIZE, IMAGENET_MEAN, IMAGENET_STD, PREPROCESSING_KEY
+
+logger = logging.getLogger(__name__)
+
+INPUT_DTYPES = {'int16': TensorProto.INT16, 'float32': TensorProto.FLOAT} # Same keys as RAW_INPUT_DTYPES
+MIN_OPSET = 11 # Clip with min/max inputs, Resize with sizes
+
+
+def prepare_model(path, window, level, output_path=None, resize=True, input_dtype='int16'):
+    if input_dtype not in INPUT_DTYPES:
+        raise ValueError(f"Unrecognised input dtype: {input_dtype}. Use one of: {list(INPUT_DTYPES.keys())}")
+    if window is None or level is None:
+        raise ValueError("Window/level must be set to fold them into the model")
+    output_path = output_path or f"{os.path.splitext(path)[0]}.prep.onnx"
+
+    model = onnx.load(path)
+    graph = model.graph
+    opset = max(x.version for x in model.opset_import if x.domain in ['', 'ai.onnx'])
+    if opset < MIN_OPSET:
+        raise ValueError(f"Model opset ({opset}) is too old, needs >= {MIN_OPSET}")
+    if any(x.key == PREPROCESSING_KEY for x in model.metadata_props):
+        raise ValueError(f"{path} has already been prepared")
+
+    ## Graph input -> tensor the pre-processing writes to (the name stays, so the model's nodes are untouched)
+    initializer_names = {x.name for x in graph.initializer}
+    model_input = [x for x in graph.input if x.name not in initializer_names][0]
+    input_name = model_input.name
+    dims = model_input.type.tensor_type.shape.dim
+    model_size = tuple(d.dim_value if d.dim_value > 0 else s for d, s in zip(dims[2:], INPUT_SIZE))
+
+    minval, maxval = level - window/2, level + window/2
+    constants = {
+        'abc_wl_min': np.array(minval, dtype=np.float32),
+        'abc_wl_max': np.array(maxval, dtype=np.float32),
+        'abc_wl_window': np.array(window, dtype=np.float32),
+        'abc_mean': IMAGENET_MEAN,
+        'abc_std': IMAGENET_STD,
+    }
+    nodes = [
+        helper.make_node('Cast', ['abc_raw_slices'], ['abc_float'], to=TensorProto.FLOAT),
+        helper.make_node('Clip', ['abc_float', 'abc_wl_min', 'abc_wl_max'], ['abc_clipped']),
+        helper.make_node('Sub', ['abc_clipped', 'abc_wl_min'], ['abc_shifted']),
+        helper.make_node('Div', ['abc_shifted', 'abc_wl_window'], ['abc_wld']),
+    ]
+    wld = 'abc_wld'
+    if resize:
+        #* Bilinear, same sampling as cv2.INTER_LINEAR. Output size: N x 1 x model_size
+        constants.update({
+            'abc_slice_start': np.array([0], dtype=np.int64),
+            'abc_slice_end': np.array([2], dtype=np.int64),
+            'abc_size': np.array(model_size, dtype=np.int64),
+            'abc_empty': np.array([], dtype=np.float32),
+        })
+        nodes += [
+            helper.make_node('Shape', [wld], ['abc_shape']),
+            helper.make_node('Slice', ['abc_shape', 'abc_slice_start', 'abc_slice_end'], ['abc_batch_channels']),
+            helper.make_node('Concat', ['abc_batch_channels', 'abc_size'], ['abc_sizes'], axis=0),
+            ## roi/scales unused: empty names from opset 13, empty tensors before that
+            helper.make_node('Resize', [wld, *(['', ''] if opset >= 13 else ['abc_empty', 'abc_empty']), 'abc_sizes'], ['abc_resized'],
+                             mode='linear', coordinate_transformation_mode='half_pixel'),
+        ]
+        wld = 'abc_resized'
+    #* N x 1 x H x W - 1 x 3 x 1 x 1 broadcasts to 3 channels
+    nodes += [
+        helper.make_node('Sub', [wld, 'abc_mean'], ['abc_centred']),
+        helper.make_node('Div', ['abc_centred', 'abc_std'], [input_name]),
+    ]
+
+    height, width = ('height', 'width') if resize else model_size
+    raw_input = helper.make_tensor_value_info('abc_raw_slices', INPUT_DTYPES[input_dtype],
+                                              [dims[0].dim_param or dims[0].dim_value or 'batch', 1, height, width])
+    graph.input.remove(model_input)
+    graph.input.insert(0, raw_input)
+    graph.initializer.extend([numpy_helper.from_array(v, name=k) for k, v in constants.items()])
+    for node in reversed(nodes):
+        graph.node.insert(0, node)
+
+    settings = {'window': window, 'level': level, 'resize': resize, 'input_size': list(model_size), 'input_dtype': input_dtype}
+    helper.set_model_props(model, {**{x.key: x.value for x in model.metadata_props}, PREPROCESSING_KEY: json.dumps(settings)})
+    onnx.checker.check_model(model)
+    onnx.save(model, output_path)
+    logger.info(f"Saved {path} with pre-processing {settings} to: {output_path}")
+    return output_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fold slice pre-processing into the segmentation models (see model_bank.py)")
+    parser.add_argument('vertebra', nargs='?', help="Level in the model bank, e.g. L3")
+    parser.add_argument('modality', nargs='?', help="Modality in the model bank, e.g. CT")
+    parser.add_argument('--all', action='store_true', help="Prepare every model in the bank")
+    parser.add_argument('-o', '--output', default=None, help="Output path (default: <model>.prep.onnx)")
+    parser.add_argument('--no-resize', action='store_true', help="Don't resize in the graph, slices must match the model's input size")
+    parser.add_argument('--input-dtype', default='int16', choices=list(INPUT_DTYPES.keys()))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.all:
+        models = [(v, m) for v in model_bank for m in model_bank[v]]
+    elif args.vertebra in model_bank and args.modality in model_bank[args.vertebra]:
+        models = [(args.vertebra, args.modality)]
+    else:
+        parser.error(f"No {args.modality} model for {args.vertebra} in the model bank")
+
+    for vertebra, modality in models:
+        entry = model_bank[vertebra][modality]
+        prepare_model(entry['path'], entry.get('window'), entry.get('level'), output_path=None if args.all else args.output,
+                      resize=not args.no_resize, input_dtype=args.input_dtype)
+
+
+if __name__ == '__main__':
+    main()
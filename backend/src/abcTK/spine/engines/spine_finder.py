@@ -5,6 +5,7 @@ from typing import Callable, Sequence, Dict, Tuple, Any, Union
 from enum import Enum
 
 from abcTK.spine.transforms import CacheObjectd, BinaryMaskd
+from abcTK.spine.inferers import get_sliding_window_params
 
 from monailabel.transform.post import Restored
 from monailabel.interfaces.tasks.infer_v2 import InferType
@@ -82,8 +83,9 @@ class SpineFinder(BasicInferTask):
         ]
 
     def inferer(self, data=None) -> Inferer:
+        sw_batch_size, overlap = get_sliding_window_params(self.roi_size, data.get("device") if data else None)
         return SlidingWindowInferer(
-            roi_size=self.roi_size, sw_batch_size=2, overlap=0.4, padding_mode="replicate", mode="gaussian"
+            roi_size=self.roi_size, sw_batch_size=sw_batch_size, overlap=overlap, padding_mode="replicate", mode="gaussian"
         )
 
     def post_transforms(self, data=None) -> Sequence[Callable]:
@@ -7,7 +7,6 @@ from monai.inferers import Inferer, SlidingWindowInferer
 from monai.transforms import (
     Activationsd,
     AsDiscreted,
-    CropForegroundd,
     EnsureChannelFirstd,
     EnsureTyped,
     GaussianSmoothd,
@@ -24,6 +23,7 @@ from monailabel.tasks.infer.basic_infer import BasicInferTask
 from monailabel.transform.post import Restored
 
 from abcTK.spine.transforms import CacheObjectd, VertebraLocalizationSegmentation, Resampled
+from abcTK.spine.inferers import get_sliding_window_params
 
 logger = logging.getLogger(__name__)
 
@@ -76,25 +76,24 @@ class VertebraFinder(BasicInferTask):
         else:
             t = [
                 EnsureTyped(keys="image", device=data.get("device") if data else None),
-                EnsureChannelFirstd(keys="label"),
                 Orientationd(keys="image", axcodes="RAS"),
                 CacheObjectd(keys="image"),
                 #Resampled(keys="image", pix_spacing=self.target_spacing),
-                Spacingd(keys=("image", "label"), pixdim=self.target_spacing),
+                Spacingd(keys="image", pixdim=self.target_spacing),
                 ScaleIntensityRanged(keys="image", a_min=24 if worldmatch_correction else -1000,
                                       a_max=2924 if worldmatch_correction else 1900, b_min=0.0, b_max=1.0, clip=True),
                 GaussianSmoothd(keys="image", sigma=0.4),
                 ScaleIntensityd(keys="image", minv=-1.0, maxv=1.0),
-                #CropForegroundd(keys=("image", "label"),source_key="label", margin=10),
             ]
 
         return t
 
     def inferer(self, data=None) -> Inferer:
+        sw_batch_size, overlap = get_sliding_window_params(self.roi_size, data.get("device") if data else None)
         return SlidingWindowInferer(
             roi_size=self.roi_size,
-            sw_batch_size=2,
-            overlap=0.4,
+            sw_batch_size=sw_batch_size,
+            overlap=overlap,
             padding_mode="replicate",
             mode="gaussian",
             device=torch.device('cpu'),
@@ -107,15 +106,19 @@ class VertebraFinder(BasicInferTask):
         return None
     
     def post_transforms(self, data=None) -> Sequence[Callable]:
-        return [
+        t = [
             # Otherwise a rather big GPU (>45GB) is needed
             EnsureTyped(keys="pred", device=torch.device("cpu")),
             Activationsd(keys="pred", softmax=True),
             AsDiscreted(keys="pred", argmax=True),
             KeepLargestConnectedComponentd(keys="pred"),
-            Restored(keys="pred", ref_image="image_cached", invert_orient=True),
-            VertebraLocalizationSegmentation(keys="pred", result="result"),
+            #* Centroids from the model-space prediction, mapped to original voxel indices through the affines
+            VertebraLocalizationSegmentation(keys="pred", result="result", ref_image="image_cached"),
         ]
+        if not (data and data.get("pipeline_mode", False)):
+            ## Only restore the full resolution label volume when it's going to be written
+            t.append(Restored(keys="pred", ref_image="image_cached", invert_orient=True))
+        return t
 
     def writer(self, data, extension=None, dtype=None) -> Tuple[Any, Any]:
         if data.get("pipeline_mode", False):
@@ -1,4 +1,3 @@
-import copy
 import logging
 import time
 from typing import Callable, Sequence
@@ -7,6 +6,8 @@ import numpy as np
 import torch
 from tqdm import tqdm
 
+from monai.transforms import SpatialCrop
+
 from monailabel.interfaces.tasks.infer_v2 import InferTask, InferType
 from monailabel.interfaces.utils.transform import run_transforms
 from monailabel.tasks.infer.basic_infer import BasicInferTask
@@ -14,6 +15,8 @@ from monailabel.transform.post import Restored
 from monailabel.transform.writer import Writer
 from monailabel.utils.others.generic import name_to_device
 
+from abcTK.spine.inferers import CROP_MARGIN_MM
+
 logger = logging.getLogger(__name__)
 
 
@@ -22,21 +25,23 @@ class InferVertebraPipeline(BasicInferTask):
         self,
         task_loc_spine: InferTask,
         task_loc_vertebra: InferTask,
-        task_seg_vertebra: InferTask,
+        task_seg_vertebra: InferTask = None,
         type=InferType.SEGMENTATION,
         description="Combines three stages for vertebra segmentation",
         **kwargs,
     ):
         self.task_loc_spine = task_loc_spine
         self.task_loc_vertebra = task_loc_vertebra
-        self.task_seg_vertebra = task_seg_vertebra
+        self.task_seg_vertebra = task_seg_vertebra # None -> centroid-only (first two stages), see also request["segment_vertebrae"]
 
+        #* Second and third stage share the same label names
+        last_task = task_seg_vertebra if task_seg_vertebra is not None else task_loc_vertebra
         super().__init__(
             path=None,
             network=None,
             type=type,
-            labels=task_seg_vertebra.labels,
-            dimension=task_seg_vertebra.dimension,
+            labels=last_task.labels,
+            dimension=last_task.dimension,
             description=description,
             **kwargs,
         )
@@ -58,22 +63,70 @@ class InferVertebraPipeline(BasicInferTask):
             e[key] = e[key] + r.get("latencies", {}).get(key, 0)
         return e
 
+    @staticmethod
+    def _count_tensors(d, storages):
+        #* Adds the buffers of every tensor/array in d to storages, keyed by data pointer so that
+        #* buffers shared between stages (e.g. the cached input image) are only counted once.
+        #* Returns the number of bytes that weren't seen before.
+        added = 0
+        for v in d.values():
+            if isinstance(v, torch.Tensor):
+                storage = v.untyped_storage()
+                ptr, nbytes = storage.data_ptr(), storage.nbytes()
+            elif isinstance(v, np.ndarray):
+                while isinstance(v.base, np.ndarray):
+                    v = v.base
+                ptr, nbytes = v.__array_interface__["data"][0], v.nbytes
+            else:
+                continue
+            if ptr not in storages:
+                storages[ptr] = nbytes
+                added += nbytes
+        return added
+
+    ## Requests only get top-level keys updated, so shallow copies are enough and
+    ## tensors (input image, cached image) are passed by reference between stages.
     def locate_spine(self, request):
-        req = copy.deepcopy(request)
+        req = dict(request)
         req.update({"pipeline_mode": True})
 
         d, r = self.task_loc_spine(req)
         
         return d, r, self._latencies(r)
 
+    @staticmethod
+    def crop_to_spine(image, label, margin_mm):
+        #* Crop the original image to the bounding box of find_spine's mask (same grid) plus a margin.
+        #* The crop updates the image affine, original_affine still refers to the full image so
+        #* find_vertebra's centroids come out in voxel indices of the full image.
+        mask = torch.as_tensor(label)
+        mask = mask[0] if mask.ndim == 4 else mask
+        spacing = [float(x) for x in image.pixdim]
+        roi_start, roi_end = [], []
+        for axis in range(3):
+            other = tuple(x for x in range(3) if x != axis)
+            idx = torch.nonzero(torch.amax(mask, dim=other) > 0)
+            if idx.numel() == 0:
+                logger.warning("Empty spine mask, running find_vertebra on the whole image")
+                return image
+            margin = int(np.ceil(margin_mm / spacing[axis]))
+            roi_start.append(max(int(idx.min()) - margin, 0))
+            roi_end.append(min(int(idx.max()) + 1 + margin, image.shape[axis + 1]))
+        logger.info(f"Cropping image for find_vertebra to {roi_start} - {roi_end} (of {list(image.shape[1:])})")
+        return SpatialCrop(roi_start=roi_start, roi_end=roi_end)(image)
+
     def locate_vertebra(self, request, image, label):
-        req = copy.deepcopy(request)
-        req.update({"image": image, "label": label, "pipeline_mode": True})
+        #* find_spine's mask is only used to crop the image, find_vertebra doesn't get (or resample) it
+        req = dict(request)
+        req.update({"image": image, "pipeline_mode": True})
+        if CROP_MARGIN_MM >= 0:
+            ## Fine pass only inside the coarse spine mask
+            req.update({"image": self.crop_to_spine(image, label, CROP_MARGIN_MM)})
         
         d, r = self.task_loc_vertebra(req)
         return d, r, self._latencies(r)
 
-    def segment_vertebra(self, request, image, centroids):
+    def segment_vertebra(self, request, image, centroids, storages=None):
         original_size = list(image.shape)
         result_mask = None
 
@@ -87,7 +140,7 @@ class InferVertebraPipeline(BasicInferTask):
             # if lkey not in ("label_20", "label_22", "label_24"):
             #     continue
 
-            req = copy.deepcopy(request)
+            req = dict(request)
             req.update(
                 {
                     "image": image,
@@ -101,6 +154,8 @@ class InferVertebraPipeline(BasicInferTask):
 
             d, r = self.task_seg_vertebra(req)
             l = self._latencies(r, l)
+            if storages is not None:
+                self._count_tensors(d, storages)
 
             image = d["image"]
             image_cached = image
@@ -128,50 +183,65 @@ class InferVertebraPipeline(BasicInferTask):
         start = time.time()
         request.update({"image_path": request.get("image")})
 
-        device = name_to_device(request.get("device", "cuda"))
+        device = name_to_device(request.get("device", "cuda" if torch.cuda.is_available() else "cpu"))
         request["device"] = device
 
+        storages = {} # data pointer -> bytes, for tensor memory accounting
+        memory = {}
+
         # Run first stage
         d1, r1, l1 = self.locate_spine(request)
         image = d1["image"]
         label = d1["pred"]
+        memory["locate_spine"] = self._count_tensors(d1, storages)
     
         # Run second stage
         d2, r2, l2 = self.locate_vertebra(request, image, label)
+        memory["locate_vertebra"] = self._count_tensors(d2, storages)
         centroids = r2["centroids"]
         logger.info(f"Centroids: {centroids}")
         if len(centroids)==0: # If no centroids
             logger.error("No centroids detected")
             return None, None
 
-        # Run third stage
-        #logger.info("~~~~~~~~~~~ Segmenting vertebra ~~~~~~~~~~~~~")
-        #result_mask, l3 = self.segment_vertebra(request, image, centroids)
-
-        # Finalize the mask/result
-        #data = copy.deepcopy(request)
-        
-        #data.update({"pred": result_mask, "image": image})
-        #data = run_transforms(data, [Restored(keys="pred", ref_image="image")], log_prefix="POST(P)", use_compose=False)
-
-        begin = time.time()
-
-        #data['result_extension'] = '.nii.gz'
-        #result_file, _ = Writer(label="pred")(data)
-        latency_write = round(time.time() - begin, 2)
+        if self.task_seg_vertebra is None or not request.get("segment_vertebrae", True):
+            logger.info("Centroids only, skipping vertebra segmentation")
+            result_file, l3, latency_write = None, None, 0
+        else:
+            # Run third stage
+            logger.info("~~~~~~~~~~~ Segmenting vertebra ~~~~~~~~~~~~~")
+            counted = sum(storages.values())
+            result_mask, l3 = self.segment_vertebra(request, image, centroids, storages=storages)
+
+            # Finalize the mask/result
+            data = dict(request)
+            
+            data.update({"pred": result_mask, "image": image})
+            self._count_tensors(data, storages)
+            memory["segment_vertebra"] = sum(storages.values()) - counted
+            data = run_transforms(data, [Restored(keys="pred", ref_image="image")], log_prefix="POST(P)", use_compose=False)
+
+            begin = time.time()
+
+            data['result_extension'] = '.nii.gz'
+            result_file, _ = Writer(label="pred")(data)
+            latency_write = round(time.time() - begin, 2)
+            logger.info(f"Result Mask (aggregated/pre-restore): {result_mask.shape}")
 
         total_latency = round(time.time() - start, 2)
+        memory["total"] = sum(storages.values())
         result_json = {
-            "label_names": self.task_seg_vertebra.labels,
+            "label_names": self.labels,
             "centroids": centroids,
             "latencies": {
                 "locate_spine": l1,
                 "locate_vertebra": l2,
-                #"segment_vertebra": l3,
+                "segment_vertebra": l3,
                 "write": latency_write,
                 "total": total_latency,
             },
+            "tensor_bytes": memory, # Bytes of tensor data held at the end of each stage (shared buffers counted once)
         }
-        result_file=None
-        #logger.info(f"Result Mask (aggregated/pre-restore): {result_mask.shape}; total_latency: {total_latency}")
+        logger.info(f"Total latency: {total_latency}")
+        logger.info(f"Tensor memory (MB): { {k: round(v / 1024**2, 1) for k, v in memory.items()} }")
         return result_file, result_json
\ No newline at end of file
@@ -0,0 +1,46 @@
+"""
+Sliding-window settings for the spine localisation stages. Number of windows evaluated per batch is picked
+from the memory/cores available to the worker, unless set in the environment.
+find_vertebra only runs inside the bounding box of find_spine's (coarse, 2 mm) mask, see InferVertebraPipeline.
+"""
+import os
+import logging
+
+import psutil
+import torch
+
+logger = logging.getLogger(__name__)
+
+#* 'auto' or a number
+SW_BATCH_SIZE = os.environ.get('SPINE_SW_BATCH_SIZE', 'auto')
+#* Changes the predictions (and centroids): lower is faster, mostly on CPU, e.g. 0.25 is ~2x fewer windows than 0.4
+SW_OVERLAP = float(os.environ.get('SPINE_SW_OVERLAP', 0.4))
+#* Margin (mm) kept around find_spine's mask when cropping the image for find_vertebra, negative disables cropping
+CROP_MARGIN_MM = float(os.environ.get('SPINE_CROP_MARGIN_MM', 15))
+
+MAX_SW_BATCH_SIZE = 8
+#* Rough peak memory of one window through the localisation SegResNets, per voxel (feature maps at full resolution)
+BYTES_PER_WINDOW_VOXEL = 4 * 32 * 6
+
+
+def get_sliding_window_params(roi_size, device=None):
+    #* Returns (sw_batch_size, overlap) for windows of roi_size evaluated on device
+    device = torch.device(device) if device is not None else torch.device('cpu')
+
+    if SW_BATCH_SIZE != 'auto':
+        sw_batch_size = int(SW_BATCH_SIZE)
+    else:
+        window_bytes = BYTES_PER_WINDOW_VOXEL
+        for x in roi_size:
+            window_bytes *= x
+        if device.type == 'cuda':
+            free_bytes, _ = torch.cuda.mem_get_info(device)
+            sw_batch_size = int(0.5 * free_bytes // window_bytes)
+        else:
+            ## On CPU batching only helps while there are idle cores to run the windows on
+            free_bytes = psutil.virtual_memory().available
+            sw_batch_size = min(int(0.5 * free_bytes // window_bytes), max(1, torch.get_num_threads() // 4))
+        sw_batch_size = max(1, min(sw_batch_size, MAX_SW_BATCH_SIZE))
+
+    logger.info(f"Sliding window on {device}: sw_batch_size={sw_batch_size}, overlap={SW_OVERLAP}")
+    return sw_batch_size, SW_OVERLAP
@@ -52,19 +52,11 @@ class spineApp(MONAILabelApp):
         self.planner = HeuristicPlanner(spatial_size=spatial_size, target_spacing=target_spacing)
 
         # app models
+        self.configs = configs
+        self.conf = conf
         self.models: Dict[str, TaskConfig] = {}
-        for n in models:
-            for k, v in configs.items():
-                if self.models.get(k):
-                    continue
-                if n == k or n == "all":
-                    logger.info(f"+++ Adding Model: {k} => {v}")
-                    self.models[k] = eval(f"{v}()")
-                    self.models[k].init(k, self.model_dir, conf, self.planner)
-                
-        logger.info(f"+++ Using Models: {list(self.models.keys())}")
-        
-        self._infers = self.init_infers()
+        self._infers: Dict[str, InferTask] = {}
+        self.add_models(models)
 
         # Load models from bundle config files, local or released in Model-Zoo, e.g., --conf bundles <spleen_ct_segmentation>
         #self.bundles = get_bundle_models(app_dir, conf, conf_key="bundles") if conf.get("bundles") else None
@@ -78,13 +70,33 @@ class spineApp(MONAILabelApp):
         #     version=monailabel.__version__,
         # )
 
-    def init_infers(self) -> Dict[str, InferTask]:
-        infers: Dict[str, InferTask] = {}
+    def add_models(self, models):
+        #* Loads the models not loaded yet (list of config names, or "all") and rebuilds the pipeline on top.
+        #* Tasks already loaded are kept, e.g. adding segment_vertebra re-uses the localisation networks
+        new_models = []
+        for n in models:
+            for k, v in self.configs.items():
+                if self.models.get(k):
+                    continue
+                if n == k or n == "all":
+                    logger.info(f"+++ Adding Model: {k} => {v}")
+                    self.models[k] = eval(f"{v}()")
+                    self.models[k].init(k, self.model_dir, self.conf, self.planner)
+                    new_models.append(k)
+
+        logger.info(f"+++ Using Models: {list(self.models.keys())}")
+        if new_models:
+            self._infers = self.init_infers(new_models)
+
+    def init_infers(self, models=None) -> Dict[str, InferTask]:
+        infers: Dict[str, InferTask] = dict(self._infers)
 
         #################################################
         # Models
         #################################################
         for n, task_config in self.models.items():
+            if models is not None and n not in models:
+                continue # Already loaded
             c = task_config.infer()
             c = c if isinstance(c, dict) else {n: c}
             for k, v in c.items():
@@ -105,7 +117,7 @@ class spineApp(MONAILabelApp):
         # Stages:
         # 1/ localization spine
         # 2/ localization vertebra
-        # 3/ segmentation vertebra
+        # 3/ segmentation vertebra (optional, without it the pipeline stops at the centroids)
         #################################################
         if (
             infers.get("find_spine")
@@ -119,6 +131,13 @@ class spineApp(MONAILabelApp):
                 task_seg_vertebra=infers["segment_vertebra"],  # third stage
                 description="Combines three stage for vertebra segmentation",
             )
+        elif infers.get("find_spine") and infers.get("find_vertebra"):
+            logger.info("--- VERTEBRA PIPELINE ACTIVE (CENTROIDS ONLY) ---")
+            infers["vertebra_pipeline"] = InferVertebraPipeline(
+                task_loc_spine=infers["find_spine"],  # first stage
+                task_loc_vertebra=infers["find_vertebra"],  # second stage
+                description="Combines two stages for vertebra localisation",
+            )
 
         
         return infers
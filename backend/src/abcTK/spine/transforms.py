@@ -5,6 +5,7 @@ import numpy as np
 from typing import Mapping, Hashable, Dict, Tuple
 
 from monai.config import NdarrayOrTensor, KeysCollection
+from monai.data import MetaTensor
 from monai.transforms import Randomizable, GaussianSmooth, SpatialCrop, Resize
 from monai.transforms.transform import (
     MapTransform,
@@ -69,52 +70,81 @@ class BinaryMaskd(MapTransform):
         return d
 
 class CacheObjectd(MapTransform):
+    """
+    Keeps a reference to the current image as `<key>_cached` before it's resampled/normalised.
+    The pixel data is shared, not copied, only the meta-data (affine, applied operations) gets its own copy.
+    Transforms that run afterwards return new tensors, so the cached object must not be modified in place.
+    """
     def __call__(self, data: Mapping[Hashable, NdarrayOrTensor]) -> Dict[Hashable, NdarrayOrTensor]:
         d: Dict = dict(data)
         for key in self.key_iterator(d):
             cache_key = f"{key}_cached"
             
             if d.get(cache_key) is None:
-                d[cache_key] = copy.deepcopy(d[key])
+                d[cache_key] = self.share(d[key])
         return d
 
+    @staticmethod
+    def share(x):
+        if isinstance(x, MetaTensor):
+            return MetaTensor(x.as_tensor(), meta=copy.deepcopy(x.meta), applied_operations=copy.deepcopy(x.applied_operations))
+        return x
+
 #** =============== STAGE 2 =======================
 
 class VertebraLocalizationSegmentation(MapTransform):
-    def __init__(self, keys: KeysCollection, result: str = "result", allow_missing_keys: bool = False):
+    def __init__(self, keys: KeysCollection, result: str = "result", ref_image: str = None, model_image: str = "image",
+                 allow_missing_keys: bool = False):
         """
         Postprocess Vertebra localization using segmentation task
 
         :param keys: The ``keys`` parameter will be used to get and set the actual data item to transform
+        :param ref_image: if given, the prediction is still in model space (same grid as ``model_image``) and centroids
+            are mapped to voxel indices of the original image through the affines, instead of restoring the label volume first.
+            ``ref_image`` is the (cached) input image, its meta has the original affine.
 
         """
         super().__init__(keys, allow_missing_keys)
         self.result = result
+        self.ref_image = ref_image
+        self.model_image = model_image
+
+    def _get_model_to_native(self, d, key):
+        #* 4x4 matrix from model voxel indices to original image voxel indices, and model/original voxel volume ratio
+        model_affine = d[key].affine if hasattr(d[key], "affine") else d[self.model_image].affine
+        model_affine = torch.as_tensor(model_affine).double().cpu().numpy()
+        native_affine = torch.as_tensor(d[self.ref_image].meta["original_affine"]).double().cpu().numpy()
+        voxel_ratio = abs(np.linalg.det(model_affine[:3, :3])) / abs(np.linalg.det(native_affine[:3, :3]))
+        return np.linalg.inv(native_affine) @ model_affine, voxel_ratio
+
+    def _get_centroids(self, label, min_size=1000, to_native=None, voxel_ratio=1.0):
+        #* Centre of mass (truncated to int) and size of every label in one pass over the volume:
+        #* voxel counts and index sums per label via bincount over the foreground voxels only.
+        #* to_native: maps centres to voxel indices of another grid, voxel_ratio scales the counts to that grid's voxels.
+        if isinstance(label, torch.Tensor):
+            label = label.detach().cpu().numpy()
+        label = np.asarray(label)
+
+        flat = label.reshape(-1)
+        foreground = np.flatnonzero(flat)
+        classes = flat[foreground].astype(np.int64)
+        indices = np.unravel_index(foreground, label.shape)
+        counts = np.bincount(classes)
+        sums = [np.bincount(classes, weights=idx, minlength=len(counts)) for idx in indices[-3:]]
 
-    def _get_centroids(self, label):
         centroids = []
-        # loop over all segments
-        areas = []
-        for seg_class in torch.unique(label):
-            c = {}
+        for seg_class in np.flatnonzero(counts):
             # skip background
             if seg_class == 0:
                 continue
-
-            # get centre of mass (CoM)
-            centre = []
-            for indices in torch.where(label == seg_class):
-                # most_indices = np.percentile(indices, 60).astype(int).tolist()
-                # centre.append(most_indices)
-                avg_indices = np.average(indices).astype(int).tolist()
-                centre.append(avg_indices)
-
-            if len(indices) < 1000:
+            if counts[seg_class] * voxel_ratio < min_size:
                 continue
-
-            areas.append(len(indices))
-            c[f"label_{int(seg_class)}"] = [int(seg_class), centre[-3], centre[-2], centre[-1]]
-            centroids.append(c)
+            centre = [axis_sum[seg_class] / counts[seg_class] for axis_sum in sums]
+            if to_native is not None:
+                centre = (to_native @ np.array([*centre, 1.0]))[:3]
+            # Same rounding as np.average(...).astype(int)
+            centre = [int(x) for x in centre]
+            centroids.append({f"label_{int(seg_class)}": [int(seg_class), centre[-3], centre[-2], centre[-1]]})
 
         # Rules to discard centroids
         # 1/ Should we consider the distance between centroids?
@@ -127,7 +157,12 @@ class VertebraLocalizationSegmentation(MapTransform):
         centroids = []
         for key in self.key_iterator(d):
             # Getting centroids
-            centroids = self._get_centroids(d[key])
+            if self.ref_image is not None:
+                to_native, voxel_ratio = self._get_model_to_native(d, key)
+                logger.info(f"Computing centroids in model space, voxel volume ratio to the original image: {voxel_ratio}")
+                centroids = self._get_centroids(d[key], to_native=to_native, voxel_ratio=voxel_ratio)
+            else:
+                centroids = self._get_centroids(d[key])
             if d.get(self.result) is None:
                 d[self.result] = dict()
             d[self.result]["centroids"] = centroids
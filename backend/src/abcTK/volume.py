@@ -0,0 +1,206 @@
+"""
+Container for an input volume, shared by every stage of a job that needs it (header parsing, geometry,
+pre-processing and sanity images). Geometry and header tags come from the file headers, pixel data is
+only decoded the first time the image itself is needed.
+"""
+import logging
+from dataclasses import dataclass, field
+from typing import Callable
+
+import numpy as np
+import SimpleITK as sitk
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class LoadedVolume():
+    """Input scan for one job: the SimpleITK image (loaded on first use), a numpy view of it and its geometry"""
+    path: str
+    loader_function: Callable = field(repr=False)
+    loader_name: str = None # As returned by get_loader_function: dicom, nifty, nrrd or numpy
+    dcm_names: list = field(default=None, repr=False) # Sorted files of the series to read (DICOM only)
+    _Image: sitk.Image = field(default=None, init=False, repr=False)
+    _probe: dict = field(default=None, init=False, repr=False)
+
+    def __post_init__(self):
+        if self.loader_name == 'dicom' and self.dcm_names is None:
+            self.dcm_names = get_dicom_series_files(self.path)
+
+    @property
+    def Image(self):
+        if self._Image is None:
+            logger.info(f"Loading volume: {self.path}")
+            if self.dcm_names is not None:
+                self._Image = read_dicom_series(self.dcm_names)
+            else:
+                self._Image = self.loader_function(self.path)
+        return self._Image
+
+    @property
+    def is_loaded(self):
+        return self._Image is not None
+
+    @property
+    def array(self):
+        #* Read-only view onto the image buffer (no copy)
+        return sitk.GetArrayViewFromImage(self.Image)
+
+    @property
+    def probe(self):
+        #* Header-only geometry + tags, falls back to the decoded image if the format has no cheap header
+        if self._probe is None:
+            if self.is_loaded:
+                self._probe = {**geometry_from_image(self.Image), 'metadata': metadata_from_image(self.Image)}
+            elif self.dcm_names is not None:
+                self._probe = probe_dicom_series(self.dcm_names)
+            elif self.loader_name in ['nifty', 'nrrd']:
+                self._probe = probe_image_file(self.path)
+            elif self.loader_name == 'numpy' and self.path.endswith('.npy'):
+                self._probe = probe_numpy(self.path)
+            else:
+                self._probe = {**geometry_from_image(self.Image), 'metadata': {}}
+        return self._probe
+
+    @property
+    def origin(self):
+        return self.probe['origin']
+
+    @property
+    def direction(self):
+        return self.probe['direction']
+
+    @property
+    def size(self):
+        return self.probe['size']
+
+    @property
+    def spacing(self):
+        return self.probe['spacing']
+
+    @property
+    def geometry(self):
+        #* Same keys as stored in the images collection (see abcTK/database/collections.py)
+        return {'origin': self.origin, 'direction': self.direction, 'size': self.size, 'spacing': self.spacing}
+
+    @property
+    def supports_slab(self):
+        #* Formats where a subset of slices can be decoded without reading the rest
+        if self.dcm_names is not None:
+            return len(self.dcm_names) == self.size[-1] # Not multi-frame
+        return self.loader_name in ['nifty', 'nrrd'] or (self.loader_name == 'numpy' and self.path.endswith('.npy'))
+
+    def read_slab(self, start, stop):
+        #* Decode only slices [start, stop) along the last image axis (k), with the geometry of that sub-volume
+        logger.info(f"Loading slices {start}-{stop-1} of {self.size[-1]} from: {self.path}")
+        if self.dcm_names is not None:
+            return read_dicom_series(self.dcm_names[start:stop])
+        elif self.loader_name == 'numpy':
+            Slab = sitk.GetImageFromArray(np.ascontiguousarray(np.load(self.path, mmap_mode='r')[start:stop]))
+            Slab.SetOrigin((0.0, 0.0, float(start))) # Unit spacing, as for the full array
+            return Slab
+
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(self.path)
+        reader.SetExtractIndex([0, 0, int(start)])
+        reader.SetExtractSize([int(self.size[0]), int(self.size[1]), int(stop - start)])
+        return reader.Execute()
+
+    def read_header(self, header_keys):
+        #* DICOM tags of the first slice of the series, None if missing
+        metadata = self.probe['metadata']
+        return {key: metadata.get(val) for key, val in header_keys.items()}
+
+
+########################################################
+#* =============== HELPER FUNCTIONS =====================
+########################################################
+def get_dicom_series_files(path, largest_series=False):
+    #* Sorted file names of the first series in a directory (or of the one with most files)
+    reader = sitk.ImageSeriesReader()
+    if not largest_series:
+        return reader.GetGDCMSeriesFileNames(path)
+
+    dcm_names = [reader.GetGDCMSeriesFileNames(path, series_id) for series_id in reader.GetGDCMSeriesIDs(path)]
+    assert len(dcm_names) > 0, f"No DICOM series found in {path}"
+    ## If more than 1
+    logger.info(f"Detected {len(dcm_names)} series in directory.")
+    if len(dcm_names) > 1:
+        ## Select the one with most files and read that
+        logger.warning("Multiple series detected, selecting the one with most files.")
+        dcm_names.sort(key=len, reverse=True)
+    return dcm_names[0]
+
+
+def read_dicom_series(dcm_names):
+    reader = sitk.ImageSeriesReader()
+    reader.SetFileNames(dcm_names)
+    Image = reader.Execute()
+    #* Keep the first slice's DICOM tags on the volume so the header doesn't need reading again. Only that file's
+    #* header is parsed, the series reader would keep a dictionary for every slice.
+    first = read_image_information(dcm_names[0], private_tags=True)
+    for k in first.GetMetaDataKeys():
+        Image.SetMetaData(k, first.GetMetaData(k))
+    return Image
+
+
+def read_image_information(path, private_tags=False):
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    if private_tags:
+        reader.LoadPrivateTagsOn()
+    reader.ReadImageInformation()
+    return reader
+
+
+def geometry_from_image(Image):
+    return {'origin': Image.GetOrigin(), 'direction': Image.GetDirection(), 'size': Image.GetSize(), 'spacing': Image.GetSpacing()}
+
+
+def metadata_from_image(Image):
+    metadata = {}
+    for k in Image.GetMetaDataKeys():
+        v = Image.GetMetaData(k)
+        metadata[k] = None if v == '' else v # Replace empty string
+    return metadata
+
+
+def probe_dicom_series(dcm_names):
+    """
+    Geometry of a DICOM series from the headers of its first and last slice, following what
+    sitk.ImageSeriesReader does: origin and in-plane axes from the first slice, slice spacing and
+    slice direction from the distance between the first and last slice positions.
+    """
+    first = read_image_information(dcm_names[0], private_tags=True)
+    metadata = metadata_from_image(first)
+    origin, direction, spacing, size = first.GetOrigin(), first.GetDirection(), first.GetSpacing(), first.GetSize()
+    if len(dcm_names) == 1:
+        ## Single (possibly multi-frame) file
+        return {'origin': origin, 'direction': direction, 'size': size, 'spacing': spacing, 'metadata': metadata}
+
+    last = read_image_information(dcm_names[-1])
+    dirN = np.array(last.GetOrigin()) - np.array(origin)
+    dirN_norm = np.linalg.norm(dirN)
+
+    spacing = (*spacing[:2], float(dirN_norm / (len(dcm_names) - 1)))
+    direction = np.array(direction).reshape(3, 3)
+    if dirN_norm > 0:
+        direction[:, 2] = dirN / dirN_norm
+    direction = tuple(float(x) for x in direction.flatten())
+    size = (*size[:2], len(dcm_names))
+    return {'origin': origin, 'direction': direction, 'size': size, 'spacing': spacing, 'metadata': metadata}
+
+
+def probe_image_file(path):
+    #* NIfTI/NRRD, header only
+    reader = read_image_information(path)
+    return {'origin': reader.GetOrigin(), 'direction': reader.GetDirection(), 'size': reader.GetSize(),
+            'spacing': reader.GetSpacing(), 'metadata': {}}
+
+
+def probe_numpy(path):
+    #* Same geometry sitk.GetImageFromArray gives (unit spacing, identity direction), read from the .npy header
+    shape = np.load(path, mmap_mode='r').shape
+    ndim = len(shape)
+    return {'origin': (0.0,)*ndim, 'direction': tuple(float(x) for x in np.eye(ndim).flatten()),
+            'size': tuple(int(x) for x in shape[::-1]), 'spacing': (1.0,)*ndim, 'metadata': {}}
@@ -1,21 +1,169 @@
 """
-Wrapper class for serializing ONNX inference session
+Wrapper class for serializing ONNX inference session, plus a per-process cache of sessions
+so long-lived workers only deserialise each model once.
 """
+import os
+import logging
+from collections import OrderedDict
+
+import onnxruntime as ort
 from onnxruntime import InferenceSession
 
+logger = logging.getLogger(__name__)
+
+#* Max. number of models kept resident in a worker process (0 disables caching)
+SESSION_CACHE_SIZE = int(os.environ.get('ONNX_SESSION_CACHE_SIZE', 4))
+_session_cache = OrderedDict()
+
+#* Session settings. Defaults come from the worker's environment so each worker type can be tuned
+#* in docker-compose, requests can override any of them with an `ort_` prefixed argument.
+SESSION_DEFAULTS = {
+    'intra_op_num_threads': os.environ.get('ORT_INTRA_OP_NUM_THREADS', '0'), # 0 -> let ORT decide
+    'inter_op_num_threads': os.environ.get('ORT_INTER_OP_NUM_THREADS', '0'),
+    'graph_optimization_level': os.environ.get('ORT_GRAPH_OPTIMIZATION_LEVEL', 'all'),
+    'execution_mode': os.environ.get('ORT_EXECUTION_MODE', 'sequential'),
+    'enable_cpu_mem_arena': os.environ.get('ORT_ENABLE_CPU_MEM_ARENA', 'true'),
+    'providers': os.environ.get('ORT_PROVIDERS', ''), # Comma-separated, in order of preference
+    'optimized_model_dir': os.environ.get('ORT_OPTIMIZED_MODEL_DIR', ''), # Where to keep graph-optimised models
+}
+
+GRAPH_OPTIMIZATION_LEVELS = {
+    'disable': ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    'basic': ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    'extended': ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    'all': ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+#* Highest level a graph is saved at. Above it ORT adds hardware/provider specific nodes that mustn't be
+#* loaded anywhere else, those optimisations are re-applied when the saved graph is loaded instead.
+SAVED_OPTIMIZATION_LEVEL = 'extended'
+
+EXECUTION_MODES = {
+    'sequential': ort.ExecutionMode.ORT_SEQUENTIAL,
+    'parallel': ort.ExecutionMode.ORT_PARALLEL,
+}
+
 
-class ONNXInferenceWrapper(InferenceSession):
-    def __init__(self, path, onnx_bytes):
-        super().__init__(path)
-        self.sess = InferenceSession(onnx_bytes.SerializeToString())
-        self.onnx_bytes = onnx_bytes
+class ONNXInferenceWrapper():
+    def __init__(self, path, session_config=None):
+        self.path = path
+        self.session_config = resolve_session_config() if session_config is None else session_config
+        self.sess = self.create_session(path, self.session_config)
 
     def run(self, *args):
         return self.sess.run(*args)
 
+    def get_inputs(self):
+        return self.sess.get_inputs()
+
+    def get_modelmeta(self):
+        return self.sess.get_modelmeta()
+
     def __getstate__(self):
-        return {'onnx_bytes': self.onnx_bytes}
+        # Sessions can't be pickled, rebuild from the model file instead
+        return {'path': self.path, 'session_config': self.session_config}
 
     def __setstate__(self, values):
-        onnx_bytes = values['onnx_bytes']
-        self.sess = InferenceSession(onnx_bytes.SerializeToString()) 
\ No newline at end of file
+        self.__init__(values['path'], values['session_config'])
+
+    @staticmethod
+    def create_session(path, session_config):
+        sess_options = ort.SessionOptions()
+        sess_options.intra_op_num_threads = session_config['intra_op_num_threads']
+        sess_options.inter_op_num_threads = session_config['inter_op_num_threads']
+        sess_options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[session_config['graph_optimization_level']]
+        sess_options.execution_mode = EXECUTION_MODES[session_config['execution_mode']]
+        sess_options.enable_cpu_mem_arena = session_config['enable_cpu_mem_arena']
+        sess_options.log_severity_level = 3
+
+        #* Explicit, so the saved graph can be keyed by them (ORT needs them set on GPU builds anyway)
+        providers = list(session_config['providers'] or ort.get_available_providers())
+
+        ## Graph optimisation is done once and the result kept on disk, later sessions load the optimised
+        ## graph directly. Saved at 'extended' at most, anything above is applied again when it's loaded.
+        optimized_path, tmp_path = None, None
+        level = session_config['graph_optimization_level']
+        if session_config['optimized_model_dir'] and level != 'disable':
+            saved_level = level if level in ['basic', 'extended'] else SAVED_OPTIMIZATION_LEVEL
+            load_level = 'disable' if level == saved_level else level
+            os.makedirs(session_config['optimized_model_dir'], exist_ok=True)
+            optimized_path = ONNXInferenceWrapper.get_optimized_path(path, session_config['optimized_model_dir'], saved_level, providers)
+            if os.path.isfile(optimized_path) and os.path.getmtime(optimized_path) >= os.path.getmtime(path):
+                logger.info(f"Loading graph-optimised model from: {optimized_path}")
+                sess_options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[load_level]
+                return InferenceSession(optimized_path, sess_options=sess_options, providers=providers)
+
+            tmp_path = f"{optimized_path}.{os.getpid()}.tmp" # Other workers may be writing the same model
+            sess_options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[saved_level]
+            sess_options.optimized_model_filepath = tmp_path
+
+        session = InferenceSession(path, sess_options=sess_options, providers=providers)
+        if tmp_path is not None and os.path.isfile(tmp_path):
+            ## Named after the providers the session really got (e.g. CPU only if CUDA failed to initialise)
+            optimized_path = ONNXInferenceWrapper.get_optimized_path(path, session_config['optimized_model_dir'], saved_level, session.get_providers())
+            logger.info(f"Saved graph-optimised model to: {optimized_path}")
+            os.replace(tmp_path, optimized_path)
+            if load_level != 'disable':
+                ## Session was only optimised up to the saved level
+                sess_options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[load_level]
+                sess_options.optimized_model_filepath = ''
+                session = InferenceSession(optimized_path, sess_options=sess_options, providers=providers)
+        logger.info(f"Session providers: {session.get_providers()}")
+        return session
+
+    @staticmethod
+    def get_optimized_path(path, optimized_model_dir, level, providers):
+        #* Saved graphs are only valid for the providers and onnxruntime version that optimised them
+        name = os.path.splitext(os.path.basename(path))[0]
+        provider_tag = '-'.join(x.replace('ExecutionProvider', '') for x in providers)
+        return os.path.join(optimized_model_dir, f"{name}.{level}.{provider_tag}.ort{ort.__version__}.onnx")
+
+
+def resolve_session_config(overrides=None):
+    #* Merge request overrides into the worker defaults and convert everything to the types ORT expects
+    config = {**SESSION_DEFAULTS, **{k: v for k, v in (overrides or {}).items() if k in SESSION_DEFAULTS}}
+    for key in ['intra_op_num_threads', 'inter_op_num_threads']:
+        config[key] = int(config[key])
+
+    if isinstance(config['enable_cpu_mem_arena'], str):
+        config['enable_cpu_mem_arena'] = config['enable_cpu_mem_arena'].lower() in ['true', '1', 'yes']
+
+    for key, options in [('graph_optimization_level', GRAPH_OPTIMIZATION_LEVELS), ('execution_mode', EXECUTION_MODES)]:
+        config[key] = str(config[key]).lower()
+        if config[key] not in options:
+            raise ValueError(f"Unrecognised ONNX Runtime {key}: {config[key]}. Use one of: {list(options.keys())}")
+
+    if isinstance(config['providers'], str):
+        config['providers'] = [x.strip() for x in config['providers'].split(',') if x.strip()]
+    available = ort.get_available_providers()
+    unavailable = [x for x in config['providers'] if x not in available]
+    if unavailable:
+        logger.warning(f"Execution providers not available in this onnxruntime build, ignoring: {unavailable}. Available: {available}")
+    config['providers'] = tuple(x for x in config['providers'] if x in available)
+    return config
+
+
+def get_inference_session(path, session_config=None):
+    #* LRU lookup keyed by model path, modification time and session settings, so replacing a model
+    #* on disk invalidates the cached session on the next job.
+    session_config = resolve_session_config() if session_config is None else session_config
+    key = (path, os.path.getmtime(path), tuple(sorted(session_config.items())))
+    if key in _session_cache:
+        logger.info(f"Re-using cached ONNX session for {path}")
+        _session_cache.move_to_end(key)
+        return _session_cache[key]
+
+    logger.info(f"Loading ONNX session for {path} with settings: {session_config}")
+    session = ONNXInferenceWrapper(path, session_config)
+    if SESSION_CACHE_SIZE <= 0:
+        return session
+
+    for stale_key in [k for k in _session_cache if k[0] == path and k[1] != key[1]]:
+        logger.info(f"Model file changed on disk, dropping cached session: {stale_key}")
+        del _session_cache[stale_key]
+
+    _session_cache[key] = session
+    while len(_session_cache) > SESSION_CACHE_SIZE:
+        evicted_key, _ = _session_cache.popitem(last=False)
+        logger.info(f"Evicting cached ONNX session: {evicted_key}")
+    return session
@@ -5,14 +5,24 @@ Base class for writing sanity predictions
 import os
 import numpy as np
 import logging
-import matplotlib.pyplot as plt
 import SimpleITK as sitk
 from scipy import signal
+from PIL import Image as PILImage, ImageDraw, ImageFont
 #
 logger= logging.getLogger(__name__)
 
+#* 'png' or 'webp'. Images are drawn straight into an RGB array (no matplotlib figures) then encoded with Pillow
+SANITY_IMAGE_FORMAT = os.environ.get('SANITY_IMAGE_FORMAT', 'png').lower()
+FONT_SIZE = 20
+PADDING = 10 # Pixels between panels
+#* Overlay colours, as matplotlib's: plasma_r for a single mask, jet across compartments for all of them
+MASK_COLOUR = (240, 249, 33)
+YELLOW, WHITE = (255, 255, 0), (255, 255, 255)
+
 class sanityWriter():
-    def __init__(self, output_dir, vertebra, slice_number, num_slices, window, level, modality, is_edit=False):
+    extension = f'.{SANITY_IMAGE_FORMAT}'
+
+    def __init__(self, output_dir, vertebra, slice_number, num_slices, window, level, modality, is_edit=False, slice_offset=0):
         self.output_dir = os.path.join(output_dir, 'sanity')
         if vertebra is not None:
             self.output_dir = os.path.join(self.output_dir, vertebra)
@@ -24,6 +34,7 @@ class sanityWriter():
         self.v_level = vertebra
         self.slice_number = slice_number
         self.num_slices = num_slices
+        self.slice_offset = slice_offset # Added to slice numbers in titles when the image is a slab of the volume
 
         self.window = window
         self.level = level
@@ -52,10 +63,8 @@ class sanityWriter():
             logger.error(f"Don't know how to plot modality: {self.modality}")
             raise ValueError
         ## Plot
-        fig, ax = plt.subplots(1, 1, figsize=(5, 7))
-        fig.patch.set_facecolor('black')
-        #ax.axis('off')
-        ax.imshow(mip, cmap='gray')
+        canvas = self.to_rgb((mip - mip.min()) / max(float(mip.max() - mip.min()), 1e-6))
+        labels = []
         ## Scale point and flip if needed
         logger.info(json)
         for vert, coords in json.items():
@@ -63,26 +72,21 @@ class sanityWriter():
             loc = coords[-1]*ratio[0] ## ratio already switched to npy array indexing
             
             # Flip slice number. Slice number comes from LPS orientation but we want LPI for plotting
-            loc = mip.shape[0] - loc - 1 #-1 Since size starts at 1 but indexing at 0
-            if self.v_level is None:
-                ax.axhline(loc, c='white', ls='--', linewidth=1)
-                ax.text(0.95, loc+20, vert, c='white')
+            loc = int(round(mip.shape[0] - loc - 1)) #-1 Since size starts at 1 but indexing at 0
+            if self.v_level is not None and vert == self.v_level:
+                self.draw_hline(canvas, loc, YELLOW, width=2)
+                labels += [(vert, (1, loc+20), YELLOW, 'ls'), (str(coords[-1]), (1, loc-20), YELLOW, 'ls')]
             else:
-                if vert == self.v_level:
-                    ax.axhline(loc, c='yellow', ls='-', linewidth=2)
-                    ax.text(0.95, loc+20, vert, c='yellow')
-                    ax.text(0.05, loc-20, coords[-1], c='yellow')
-                else:
-                    ax.axhline(loc, c='white', ls='--', linewidth=1)
-                    ax.text(0.95, loc+20, vert, c='white')
-        
+                self.draw_hline(canvas, loc, WHITE, width=1, dash=6)
+                labels.append((vert, (1, loc+20), WHITE, 'ls'))
+
         if self.v_level is None:
-            output_filename = os.path.join(self.output_dir, tag + '.png')
+            output_filename = os.path.join(self.output_dir, tag + self.extension)
         else:
-            output_filename = os.path.join(self.output_dir, tag +f'-{self.v_level}.png')
+            output_filename = os.path.join(self.output_dir, tag +f'-{self.v_level}{self.extension}')
 
         logger.info(f"Writing quality control image to {output_filename}")
-        fig.savefig(output_filename)
+        self.save(canvas, output_filename, labels)
         if self.v_level is None:
             return output_filename
         else:
@@ -94,76 +98,129 @@ class sanityWriter():
         img = image[self.slice_number-self.num_slices:self.slice_number+self.num_slices+1]
 
         total_slices = 2*self.num_slices+1
-        if total_slices == 1:
-            fig, ax = plt.subplots(1, 1, figsize=(20, 5))
-            ax = [ax] # To make subscriptable for plotting
-        else:
-            if total_slices <= 5:
-                fig, ax = plt.subplots(1, total_slices, figsize=(20, 5))
-            else:
-                fig, axes = plt.subplots(2, total_slices//2, figsize=(20, 10))
-                ax = axes.ravel()
-        fig.patch.set_facecolor('black')
-
-        slice_nums = np.arange(self.slice_number-self.num_slices, self.slice_number+self.num_slices+1, 1)
+        slice_nums = np.arange(self.slice_number-self.num_slices, self.slice_number+self.num_slices+1, 1) + self.slice_offset
+        panels = []
         for i in range(total_slices):
-            pred = prediction[i]
-            im = self.wl_norm(img[i], self.window, self.level)
-            ax[i].set_title(f'Slice: {slice_nums[i]}', c='white', size=20)
-            ax[i].imshow(im, cmap='gray')
-            ax[i].imshow(np.where(pred == 0, np.nan, pred), cmap='plasma_r', alpha=0.5)
-        output_filename = os.path.join(self.output_dir, tag +'.png')
-        #output_filename = os.path.join(self.output_dir, tag + '.png')
-        fig.savefig(output_filename)
+            im = self.to_rgb(self.wl_norm(img[i], self.window, self.level))
+            panels.append(self.overlay(im, prediction[i] != 0, np.array(MASK_COLOUR), alpha=0.5))
+        canvas, labels = self.tile(panels, [f'Slice: {x}' for x in slice_nums])
+        output_filename = os.path.join(self.output_dir, tag + self.extension)
+        self.save(canvas, output_filename, labels)
         return {self.v_level: output_filename}
 
     def write_all_segmentation_sanity(self, tag, image, mask, filter):
         ## Filter is used to figure out what data we expect
-        prediction = np.zeros_like(mask['skeletal_muscle'])
+        slices = slice(self.slice_number-self.num_slices, self.slice_number+self.num_slices+1)
+        prediction = np.zeros_like(mask['skeletal_muscle'][slices])
 
-        ## Setup figure
         total_slices = 2*self.num_slices+1
-        if total_slices == 1:
-            fig, ax = plt.subplots(1, 1, figsize=(20, 5))
-            ax = [ax] # To make subscriptable for plotting
-        else:
-            if total_slices <= 5:
-                fig, ax = plt.subplots(1, total_slices, figsize=(20, 5))
-            else:
-                fig, axes = plt.subplots(2, total_slices//2, figsize=(20, 10))
-                ax = axes.ravel()
-        fig.patch.set_facecolor('black')
-
         for i, key in enumerate(filter.keys()):
             logger.info(f"Adding {key} to prediction")
             ## Merge predictions
-            prediction += (i+1)*mask[key]
+            prediction += (i+1)*mask[key][slices]
 
         logger.info(f"PLOTTING {tag} with mask shape: {prediction.shape}")
         
         ## Crop image axially around body, helps with QA (esp. of CBCT)
         nonzero = np.nonzero(prediction)
-        min_x, max_x = min(nonzero[1]), max(nonzero[1])
-        min_y, max_y = min(nonzero[2]), max(nonzero[2])
-       
+        if len(nonzero[0]):
+            min_x, max_x = min(nonzero[1]), max(nonzero[1])
+            min_y, max_y = min(nonzero[2]), max(nonzero[2])
+            min_x, min_y = max(min_x-10, 0), max(min_y-10, 0)
+            img = image[slices, min_x:max_x+10, min_y:max_y+10]
+            prediction = prediction[:, min_x:max_x+10, min_y:max_y+10]
+        else:
+            ## Nothing segmented, plain (uncropped, uncoloured) slices
+            logger.warning(f"{tag}: every mask is empty on the plotted slices")
+            img = image[slices]
 
-        img = image[self.slice_number-self.num_slices:self.slice_number+self.num_slices+1, min_x-10:max_x+10, min_y-10:max_y+10]
-        prediction = prediction[self.slice_number-self.num_slices:self.slice_number+self.num_slices+1, min_x-10:max_x+10, min_y-10:max_y+10]
+        ## One jet colour per label value, over the range of values present
+        values = np.unique(prediction[prediction != 0])
+        colours = np.zeros((int(values.max()) + 1 if len(values) else 1, 3))
+        if len(values):
+            colours[values] = self.jet((values - values.min()) / max(values.max() - values.min(), 1))
 
-        slice_nums = np.arange(self.slice_number-self.num_slices, self.slice_number+self.num_slices+1, 1)
+        slice_nums = np.arange(self.slice_number-self.num_slices, self.slice_number+self.num_slices+1, 1) + self.slice_offset
+        panels = []
         for i in range(total_slices):
             pred = prediction[i]
-            im = self.wl_norm(img[i], self.window, self.level)
-            ax[i].set_title(f'Slice: {slice_nums[i]}', c='white', size=20)
-            ax[i].imshow(im, cmap='gray')
-            ax[i].imshow(np.where(pred == 0, np.nan, pred), cmap='jet', alpha=0.25)
-        output_filename = os.path.join(self.output_dir, tag +'.png')
-        #output_filename = os.path.join(self.output_dir, tag + '.png')
-        fig.savefig(output_filename)
+            im = self.to_rgb(self.wl_norm(img[i], self.window, self.level))
+            panels.append(self.overlay(im, pred != 0, colours[pred], alpha=0.25))
+        canvas, labels = self.tile(panels, [f'Slice: {x}' for x in slice_nums])
+        output_filename = os.path.join(self.output_dir, tag + self.extension)
+        self.save(canvas, output_filename, labels)
         return {self.v_level: output_filename}
 
 
     #####################  HELPERS #############
+    @staticmethod
+    def to_rgb(img):
+        #* [0, 1] image -> uint8 grey RGB
+        grey = np.clip(np.asarray(img, dtype=np.float32) * 255, 0, 255).astype(np.uint8)
+        return np.repeat(grey[..., None], 3, axis=-1)
+
+    @staticmethod
+    def overlay(rgb, mask, colour, alpha):
+        #* Blend colour (RGB, or an array of them per pixel) into rgb where mask is set
+        if np.ndim(colour) > 1:
+            colour = colour[mask]
+        rgb[mask] = ((1 - alpha) * rgb[mask] + alpha * colour).astype(np.uint8)
+        return rgb
+
+    @staticmethod
+    def jet(x):
+        #* matplotlib's jet colourmap, x in [0, 1] -> RGB in [0, 255]
+        x = np.asarray(x, dtype=np.float32)[..., None]
+        return 255 * np.clip(1.5 - np.abs(4 * x - np.array([3, 2, 1])), 0, 1)
+
+    @staticmethod
+    def draw_hline(rgb, row, colour, width=1, dash=None):
+        if not 0 <= row < rgb.shape[0]:
+            return
+        cols = np.arange(rgb.shape[1])
+        if dash is not None:
+            cols = cols[(cols // dash) % 2 == 0]
+        rgb[max(row - width//2, 0):row - width//2 + width, cols] = colour
+
+    @staticmethod
+    def tile(panels, titles):
+        #* Panels side by side (two rows above 5) on black, with a title above each.
+        #* Returns the canvas and the labels to draw onto it, see save
+        rows = 1 if len(panels) <= 5 else 2
+        cols = int(np.ceil(len(panels) / rows))
+        height = max(x.shape[0] for x in panels) + FONT_SIZE + 2*PADDING
+        width = max(x.shape[1] for x in panels) + PADDING
+        canvas = np.zeros((rows*height, cols*width + PADDING, 3), dtype=np.uint8)
+        labels = []
+        for i, (panel, title) in enumerate(zip(panels, titles)):
+            top, left = (i // cols)*height + FONT_SIZE + 2*PADDING, (i % cols)*width + PADDING
+            canvas[top:top + panel.shape[0], left:left + panel.shape[1]] = panel
+            labels.append((title, (left + panel.shape[1]//2, top - PADDING//2), WHITE, 'ms'))
+        return canvas, labels
+
+    @staticmethod
+    def get_font():
+        try:
+            return ImageFont.truetype('DejaVuSans.ttf', FONT_SIZE)
+        except OSError:
+            return ImageFont.load_default()
+
+    @staticmethod
+    def save(rgb, output_filename, labels=()):
+        #* labels: (text, (x, y), colour, anchor) drawn onto rgb before it's encoded
+        Image = PILImage.fromarray(rgb)
+        if labels:
+            draw, font = ImageDraw.Draw(Image), sanityWriter.get_font()
+            for text, xy, colour, anchor in labels:
+                try:
+                    draw.text(xy, text, fill=colour, font=font, anchor=anchor)
+                except ValueError: # Bitmap fallback font has no anchors
+                    draw.text(xy, text, fill=colour, font=font)
+        if SANITY_IMAGE_FORMAT == 'webp':
+            Image.save(output_filename, format='WEBP', quality=90)
+        else:
+            Image.save(output_filename, format='PNG', compress_level=1)
+
     @staticmethod
     def wl_norm(img, window, level):
         minval = level - window/2
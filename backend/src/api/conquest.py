@@ -111,16 +111,21 @@ def handle_trigger():
 
         from abcTK.segment.model_bank import model_bank
         levels = [k for k, v in model_bank.items() if modality in v.keys()]
+        vertebrae = []
         for level in response['prediction'].keys():
             if level not in levels:
                 logger.info(f"No {modality} model for {level} vertebra, not submitting job...")
                 continue
-            segment_body = {"input_path": image_path, "project": UNASSIGNED_PROJECT, "patient_id": patient_id, "vertebra": level,
-            'series_uuid': series_uid, "modality": modality,  "num_slices": "1", "resample": "True", "reference_scan": response['_id'],
-              'calibrate_cbct': 'True', 'calibration_structure': 'brainstem'}
-            segment_body['depends_on'] = register.json()['job-ID'] ## Segment job waits for the registration to complete
-            logger.info(f"Submitting: {segment_body}")
-            segment = requests.post(segment_url, json=segment_body, verify=False) ## Submit segment job
+            vertebrae.append(level)
+        if not vertebrae:
+            raise ValueError(f"No {modality} models for any of the labelled levels: {list(response['prediction'].keys())}")
+        ## One segment job for all levels, so the CBCT is only loaded/calibrated once
+        segment_body = {"input_path": image_path, "project": UNASSIGNED_PROJECT, "patient_id": patient_id, "vertebrae": vertebrae,
+        'series_uuid': series_uid, "modality": modality,  "num_slices": "1", "resample": "True", "reference_scan": response['_id'],
+          'calibrate_cbct': 'True', 'calibration_structure': 'brainstem'}
+        segment_body['depends_on'] = register.json()['job-ID'] ## Segment job waits for the registration to complete
+        logger.info(f"Submitting: {segment_body}")
+        segment = requests.post(segment_url, json=segment_body, verify=False) ## Submit segment job
 
     elif modality == 'RTSTRUCT':
         ## Handle RT STRUCT
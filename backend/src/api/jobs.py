@@ -15,6 +15,9 @@ from werkzeug.utils import secure_filename
 bp = Blueprint('api/jobs', __name__)
 logger = logging.getLogger(__name__)
 
+#* Spine jobs can also run on CPU (cpu-workers), which takes longer than on a GPU
+SPINE_JOB_TIMEOUT = 900
+
 
 @bp.route('/api/jobs/infer/spine', methods=["POST"])
 def queue_infer_spine():
@@ -24,9 +27,9 @@ def queue_infer_spine():
     from app import redis
     from abcTK.inference.spine import infer_spine
     
-    # Sent to high queue for processing by GPU worker
+    # Sent to high queue: processed by a GPU worker, or on CPU by a cpu-worker (see CPU_WORKER_QUEUES)
     q = Queue('high', connection=redis, serializer=dill)
-    job = q.enqueue(infer_spine, req, job_timeout=300)
+    job = q.enqueue(infer_spine, req, job_timeout=SPINE_JOB_TIMEOUT)
 
     res = make_response(jsonify({
             "message": "Spine inference submitted",
@@ -66,25 +69,22 @@ def queue_infer_segment():
     
     req['APP_OUTPUT_DIR'] = current_app.config['OUTPUT_DIR']
     from app import redis
-    from abcTK.inference.segment import infer_segment
+    from abcTK.inference.segment import infer_segment, infer_segment_multi
     q = Queue('default', connection=redis, serializer=dill) # Sent to default queue
 
     if 'vertebra' not in req:
         
         # Check all available models in model bank
         from abcTK.segment.model_bank import model_bank
-        levels = [k for k, v in model_bank.items() if req['modality'] in v.keys()]
+        levels = req.get('vertebrae', [k for k, v in model_bank.items() if req.get('modality', 'CT') in v.keys()])
         logger.warn(f"No vertebra specified, attempting to segment the following: {levels}")
-        jobs = []
-        for level in levels:
-            req['vertebra'] = level
-            job = q.enqueue(infer_segment, req, depends_on=req['depends_on'])
-            jobs.append(job.id)
+        ## One job for every level, so the image is only loaded and pre-processed once
+        job = q.enqueue(infer_segment_multi, req, depends_on=req['depends_on'])
         res = make_response(jsonify({
                 "message": "Segmentation inference submitted",
                 "request": req,
                 "level": levels,
-                "job-ID": jobs})
+                "job-ID": job.id})
                 , 200)
     else:
         job = q.enqueue(infer_segment, req, depends_on=req['depends_on'])
@@ -173,7 +173,7 @@ def submit_jobs_from_csv():
 
     from app import redis
     from abcTK.inference.spine import infer_spine
-    from abcTK.inference.segment import infer_segment
+    from abcTK.inference.segment import infer_segment, infer_segment_multi
 
     output_dir = current_app.config['OUTPUT_DIR']
     spine_queue = Queue('high', connection=redis, serializer=dill)
@@ -197,13 +197,15 @@ def submit_jobs_from_csv():
         spine_job = None
         if job_type in ('spine', 'full'):
             spine_body = {**row_args, "project": row_project, "APP_OUTPUT_DIR": output_dir}
-            spine_job = spine_queue.enqueue(infer_spine, spine_body, job_timeout=300)
+            spine_job = spine_queue.enqueue(infer_spine, spine_body, job_timeout=SPINE_JOB_TIMEOUT)
             entry["spine_job_id"] = spine_job.id
 
         if job_type in ('segment', 'full'):
             segment_body = {**row_args, "project": row_project, "APP_OUTPUT_DIR": output_dir}
             depends_on = spine_job.id if spine_job is not None else None
-            segment_job = segment_queue.enqueue(infer_segment, segment_body, depends_on=depends_on)
+            ## No vertebra -> every level with a model, in one job
+            segment_function = infer_segment if 'vertebra' in segment_body else infer_segment_multi
+            segment_job = segment_queue.enqueue(segment_function, segment_body, depends_on=depends_on)
             entry["segment_job_id"] = segment_job.id
 
         submitted.append(entry)
@@ -25,6 +25,8 @@ from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image as RL
 
 from rt_utils import RTStructBuilder
 
+import abcTK.segment.mask_store as mask_store
+
 
 bp = Blueprint('api/post_process', __name__)
 logger = logging.getLogger(__name__)
@@ -43,6 +45,11 @@ def getRTStruct():
     ## Go through output dir and read all masks into one RT-Struct
     Masks = {filename.rstrip('.nii.gz'): sitk.ReadImage(os.path.join(path_to_preds, filename)) \
              for filename in os.listdir(path_to_preds) if filename.endswith('.nii.gz')}
+    ## Multi-label masks (masks/<level>/labels.nii.gz), one ROI per level and compartment
+    for level in sorted(os.listdir(path_to_preds)):
+        level_dir = os.path.join(path_to_preds, level)
+        if os.path.isdir(level_dir) and mask_store.has_labels(level_dir):
+            Masks.update({f"{level}_{name}": Mask for name, Mask in mask_store.read(level_dir).items()})
 
     ### Account for different mount points
     if 'arc001' in response['input_path']: # If reading from xnat archive
@@ -317,36 +324,57 @@ def export_segmentations():
     
     res = database.segmentation.find_one({"_id": _id, "project": project})
 
+    ## Read from the multi-label mask, if the job wrote one (abcTK/segment/mask_store.py). Masks are per level there
+    export_mask = None
+    names = ['skeletal_muscle', 'IMAT'] if compartment == 'total_muscle' else [compartment]
+    levels = [req['vertebra']] if 'vertebra' in req else sorted(res.get('statistics', {}).keys())
+    levels = [x for x in levels if mask_store.has_labels(os.path.join(res['output_dir'], 'masks', x))]
+    if len(levels) > 1:
+        res = make_response(jsonify({
+            "message": f"Masks were saved for several levels ({levels}), set vertebra to pick one.",
+        }), 400)
+        return res
+    if levels:
+        level_dir = os.path.join(res['output_dir'], 'masks', levels[0])
+        Masks = mask_store.read(level_dir, names)
+        if Masks:
+            logger.info(f"Reading {list(Masks.keys())} from multi-label mask in {level_dir}")
+            mask = np.max(np.stack([sitk.GetArrayFromImage(x) for x in Masks.values()]), axis=0)
+            export_mask = sitk.GetImageFromArray(mask)
+            export_mask.CopyInformation(next(iter(Masks.values())))
+            path_to_mask = 'TOTAL_MUSCLE.nii.gz' if compartment == 'total_muscle' else f'{compartment}.nii.gz'
+
     ## Find the mask to move
-    if compartment == 'total_muscle':
-        # If total muscle, read MUSCLE and IMAT masks, and combine
-        holder = []
-        for file in compartment_to_filename[compartment]:
-            logger.info(f"Adding {file} to mask.")
-            try:
-                Mask = sitk.ReadImage(os.path.join(res['output_dir'], 'masks', file)) 
-            except RuntimeError:
-                logger.warn(f"Could not find mask {file} in {os.path.join(res['output_dir'], 'masks')}")
-                continue
-            logger.info(f"Read mask with size {Mask.GetSize()}")
-            mask = sitk.GetArrayFromImage(Mask).astype(int)
-            holder.append(mask[None]) # Add extra dimension to stack along
-        total_muscle_mask = np.max(np.vstack(holder), axis=0)
-        Total_muscle_mask = sitk.GetImageFromArray(total_muscle_mask)
-        Total_muscle_mask.CopyInformation(Mask)
-        path_to_mask = os.path.join(res['output_dir'], 'masks', 'TOTAL_MUSCLE.nii.gz')
-
-        logger.info(f"Writing total muscle mask to {path_to_mask}")
-        sitk.WriteImage(Total_muscle_mask, path_to_mask)
-    
-    else:
-        for file in compartment_to_filename[compartment]:
-            try:
-                path_to_mask = os.path.join(res['output_dir'], 'masks', compartment_to_filename[compartment])
-            except RuntimeError:
-                logger.warn(f"Could not find mask {file} in {os.path.join(res['output_dir'], 'masks')}")
-                continue
-        print(path_to_mask, flush=True)
+    if export_mask is None:
+        if compartment == 'total_muscle':
+            # If total muscle, read MUSCLE and IMAT masks, and combine
+            holder = []
+            for file in compartment_to_filename[compartment]:
+                logger.info(f"Adding {file} to mask.")
+                try:
+                    Mask = sitk.ReadImage(os.path.join(res['output_dir'], 'masks', file)) 
+                except RuntimeError:
+                    logger.warn(f"Could not find mask {file} in {os.path.join(res['output_dir'], 'masks')}")
+                    continue
+                logger.info(f"Read mask with size {Mask.GetSize()}")
+                mask = sitk.GetArrayFromImage(Mask).astype(int)
+                holder.append(mask[None]) # Add extra dimension to stack along
+            total_muscle_mask = np.max(np.vstack(holder), axis=0)
+            Total_muscle_mask = sitk.GetImageFromArray(total_muscle_mask)
+            Total_muscle_mask.CopyInformation(Mask)
+            path_to_mask = os.path.join(res['output_dir'], 'masks', 'TOTAL_MUSCLE.nii.gz')
+
+            logger.info(f"Writing total muscle mask to {path_to_mask}")
+            sitk.WriteImage(Total_muscle_mask, path_to_mask)
+        
+        else:
+            for file in compartment_to_filename[compartment]:
+                try:
+                    path_to_mask = os.path.join(res['output_dir'], 'masks', compartment_to_filename[compartment])
+                except RuntimeError:
+                    logger.warn(f"Could not find mask {file} in {os.path.join(res['output_dir'], 'masks')}")
+                    continue
+            print(path_to_mask, flush=True)
     
     # Get path to scan
     #TODO THIS IS A TEMPORARY FIX AND NEEDS TO GO ASAP
@@ -371,7 +399,10 @@ def export_segmentations():
     # Copy to output directory
     output_dir = os.path.join('/data/outputs', project,  output_dir_name, res['patient_id'].strip(), _id)
     os.makedirs(output_dir, exist_ok=True)
-    shutil.copy(path_to_mask, output_dir)
+    if export_mask is None:
+        shutil.copy(path_to_mask, output_dir)
+    else:
+        sitk.WriteImage(export_mask, os.path.join(output_dir, path_to_mask))
     shutil.copytree(input_path, os.path.join(output_dir, 'SCAN'))
     
     res = make_response(jsonify({
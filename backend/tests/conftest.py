@@ -0,0 +1,5 @@
+import os
+import sys
+
+#* Tests import the backend's packages (abcTK, api) like the app does, from backend/src
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
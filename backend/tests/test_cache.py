@@ -0,0 +1,77 @@
+"""
+Pre-processed volume cache (abcTK/segment/cache.py): keys, round trip and least recently used eviction.
+"""
+import os
+
+import numpy as np
+import pytest
+
+import abcTK.segment.cache as cache
+
+META = {'geometry': {'origin': [0, 0, 0], 'spacing': [1, 1, 2], 'direction': [1, 0, 0, 0, 1, 0, 0, 0, 1], 'size': [8, 8, 4]},
+        'flipped': True}
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, 'CACHE_DIR', str(tmp_path / 'cache'))
+    os.makedirs(cache.CACHE_DIR)
+    return cache.CACHE_DIR
+
+
+@pytest.fixture
+def input_path(tmp_path):
+    path = tmp_path / 'image.nii.gz'
+    path.write_bytes(b'scan')
+    return str(path)
+
+
+def test_cache_key(cache_dir, input_path):
+    key = cache.get_cache_key('series', input_path, worldmatch_correction=False)
+
+    assert key == cache.get_cache_key('series', input_path, worldmatch_correction=False)
+    assert key != cache.get_cache_key('series', input_path, worldmatch_correction=True)
+    assert key != cache.get_cache_key('other', input_path, worldmatch_correction=False)
+    os.utime(input_path, (0, 0)) # Scan changed on disk
+    assert key != cache.get_cache_key('series', input_path, worldmatch_correction=False)
+
+
+def test_cache_disabled(monkeypatch, input_path):
+    monkeypatch.setattr(cache, 'CACHE_DIR', '')
+    assert cache.get_cache_key('series', input_path) is None
+
+
+def test_round_trip(cache_dir, input_path):
+    rng = np.random.default_rng(0)
+    image, bone = rng.normal(size=(4, 8, 8)).astype(np.float32), rng.random((4, 8, 8)) > 0.5
+    key = cache.get_cache_key('series', input_path)
+    assert cache.read(key) is None
+
+    cache.write(key, image, bone, META)
+    cached_image, cached_bone, meta = cache.read(key)
+
+    np.testing.assert_array_equal(cached_image, image)
+    np.testing.assert_array_equal(cached_bone, bone)
+    assert not cached_image.flags.writeable # Memory-mapped, shared between jobs
+    assert meta == {**META, 'has_bone': True}
+
+
+def test_round_trip_without_bone(cache_dir, input_path):
+    key = cache.get_cache_key('series', input_path)
+
+    cache.write(key, np.zeros((2, 4, 4), dtype=np.float32), None, META)
+
+    assert cache.read(key)[1] is None
+
+
+def test_evict_least_recently_used(cache_dir):
+    image = np.zeros((4, 16, 16), dtype=np.float32)
+    for i, key in enumerate(['a', 'b', 'c']):
+        cache.write(key, image, None, META)
+        os.utime(os.path.join(cache_dir, key), (i, i))
+    cache.read('a') # Now the most recently used
+    entry_bytes = sum(os.path.getsize(os.path.join(cache_dir, 'a', x)) for x in os.listdir(os.path.join(cache_dir, 'a')))
+
+    cache.evict(2 * entry_bytes)
+
+    assert sorted(os.listdir(cache_dir)) == ['a', 'c']
@@ -0,0 +1,90 @@
+"""
+Multi-label mask output (abcTK/segment/mask_store.py): bit-packed round trip, cropping and merging.
+"""
+import os
+
+import numpy as np
+import pytest
+
+sitk = pytest.importorskip('SimpleITK')
+
+import abcTK.segment.mask_store as mask_store
+
+SHAPE = (10, 32, 24) # z, y, x
+
+
+def make_mask(array):
+    Mask = sitk.GetImageFromArray(array.astype(np.uint8))
+    Mask.SetSpacing((0.8, 0.8, 2.5))
+    Mask.SetOrigin((-12.0, 30.0, 100.0))
+    Mask.SetDirection((1, 0, 0, 0, -1, 0, 0, 0, -1))
+    return Mask
+
+
+@pytest.fixture
+def masks():
+    #* Overlapping compartments in a small part of the volume
+    arrays = {x: np.zeros(SHAPE, dtype=np.uint8) for x in ['skeletal_muscle', 'IMAT', 'subcutaneous_fat']}
+    arrays['skeletal_muscle'][4:7, 10:20, 5:15] = 1
+    arrays['IMAT'][5, 12:14, 6:8] = 1
+    arrays['subcutaneous_fat'][4:7, 8:22, 3:18] = np.random.default_rng(0).random((3, 14, 15)) > 0.5
+    return arrays
+
+
+def assert_round_trip(Masks, arrays):
+    assert sorted(Masks.keys()) == sorted(arrays.keys())
+    for name, array in arrays.items():
+        np.testing.assert_array_equal(sitk.GetArrayViewFromImage(Masks[name]), array)
+        assert Masks[name].GetSize() == (SHAPE[2], SHAPE[1], SHAPE[0])
+        np.testing.assert_allclose(Masks[name].GetOrigin(), (-12.0, 30.0, 100.0))
+        np.testing.assert_allclose(Masks[name].GetDirection(), (1, 0, 0, 0, -1, 0, 0, 0, -1))
+
+
+@pytest.mark.parametrize('crop', [True, False])
+def test_round_trip(tmp_path, masks, crop):
+    level_dir = str(tmp_path / 'L3')
+
+    mask_store.write(level_dir, {x: make_mask(y) for x, y in masks.items()}, crop=crop)
+
+    assert mask_store.has_labels(level_dir)
+    assert_round_trip(mask_store.read(level_dir), masks)
+    assert mask_store.read(level_dir, ['IMAT', 'visceral_fat']).keys() == {'IMAT'}
+
+
+def test_crop(tmp_path, masks):
+    level_dir = str(tmp_path / 'L3')
+
+    mask_store.write(level_dir, {x: make_mask(y) for x, y in masks.items()}, crop=True)
+
+    Labels = sitk.ReadImage(os.path.join(level_dir, mask_store.LABELS_FILENAME))
+    nonzero = np.nonzero(np.max(np.stack(list(masks.values())), axis=0))
+    assert Labels.GetSize()[::-1] == tuple(int(x.max() - x.min() + 1) for x in nonzero)
+    start = [int(x.min()) for x in nonzero][::-1]
+    np.testing.assert_allclose(Labels.GetOrigin(), make_mask(masks['IMAT']).TransformIndexToPhysicalPoint(start))
+
+
+def test_empty_masks(tmp_path):
+    level_dir = str(tmp_path / 'L3')
+    arrays = {'skeletal_muscle': np.zeros(SHAPE, dtype=np.uint8)}
+
+    mask_store.write(level_dir, {x: make_mask(y) for x, y in arrays.items()}, crop=True)
+
+    assert_round_trip(mask_store.read(level_dir), arrays)
+
+
+def test_merge(tmp_path, masks):
+    #* Re-writing one compartment keeps the others already stored
+    level_dir = str(tmp_path / 'L3')
+    mask_store.write(level_dir, {x: make_mask(y) for x, y in masks.items()})
+    masks['skeletal_muscle'] = np.zeros(SHAPE, dtype=np.uint8)
+    masks['skeletal_muscle'][0, :5, :5] = 1
+
+    mask_store.write(level_dir, {'skeletal_muscle': make_mask(masks['skeletal_muscle'])}, merge=True)
+
+    assert_round_trip(mask_store.read(level_dir), masks)
+
+
+def test_too_many_labels(tmp_path):
+    Masks = {f'compartment_{i}': make_mask(np.zeros(SHAPE)) for i in range(mask_store.MAX_LABELS + 1)}
+    with pytest.raises(ValueError):
+        mask_store.write(str(tmp_path / 'L3'), Masks)
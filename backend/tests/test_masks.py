@@ -0,0 +1,88 @@
+"""
+Mask helpers (abcTK/segment/masks.py): logits to masks, and re-indexing onto a grid against SimpleITK's nearest-neighbour resampling.
+"""
+import itertools
+
+import numpy as np
+import pytest
+
+sitk = pytest.importorskip('SimpleITK')
+
+from abcTK.segment import masks
+
+SIZE = (7, 6, 5) # x, y, z
+
+
+def signed_permutations():
+    for axes in itertools.permutations(range(3)):
+        for signs in itertools.product([1, -1], repeat=3):
+            direction = np.zeros((3, 3))
+            direction[axes, range(3)] = signs
+            yield direction
+
+
+def make_mask(direction, origin=(10.0, -20.0, 5.0), spacing=(0.8, 0.8, 2.5)):
+    rng = np.random.default_rng(0)
+    Mask = sitk.GetImageFromArray(rng.integers(0, 2, SIZE[::-1]).astype(np.uint8))
+    Mask.SetSpacing(spacing)
+    Mask.SetOrigin(origin)
+    Mask.SetDirection(tuple(float(x) for x in direction.flatten()))
+    return Mask
+
+
+@pytest.mark.parametrize('direction', list(signed_permutations()))
+def test_remap_matches_resample(direction):
+    #* Mask reoriented (as load_data does), then put back on the original grid
+    Mask = make_mask(direction)
+    geometry = masks.get_geometry(Mask)
+    Moved = sitk.DICOMOrient(Mask, 'LPS')
+
+    mapping = masks.grid_mapping(Moved, geometry)
+    assert mapping is not None
+
+    Remapped = masks.remap_to_geometry(sitk.GetArrayViewFromImage(Moved), mapping, geometry)
+    Resampled = masks.resample_to_geometry(Moved, geometry)
+    np.testing.assert_array_equal(sitk.GetArrayViewFromImage(Remapped), sitk.GetArrayViewFromImage(Resampled))
+    np.testing.assert_array_equal(sitk.GetArrayViewFromImage(Remapped), sitk.GetArrayViewFromImage(Mask))
+    assert Remapped.GetSize() == Mask.GetSize()
+    np.testing.assert_allclose(Remapped.GetOrigin(), Mask.GetOrigin())
+
+
+def test_remap_slab_onto_full_grid():
+    #* A few slices of the volume, zeros elsewhere
+    Mask = make_mask(np.diag([1, -1, -1]))
+    geometry = masks.get_geometry(Mask)
+    Slab = Mask[:, :, 1:3]
+
+    mapping = masks.grid_mapping(Slab, geometry)
+    Remapped = masks.remap_to_geometry(sitk.GetArrayViewFromImage(Slab), mapping, geometry)
+    Resampled = masks.resample_to_geometry(Slab, geometry)
+
+    np.testing.assert_array_equal(sitk.GetArrayViewFromImage(Remapped), sitk.GetArrayViewFromImage(Resampled))
+    assert sitk.GetArrayViewFromImage(Remapped)[[0, 3, 4]].sum() == 0
+
+
+def test_grid_mapping_off_grid():
+    Mask = make_mask(np.eye(3))
+    geometry = masks.get_geometry(Mask)
+    assert masks.grid_mapping(make_mask(np.eye(3), origin=(10.3, -20.0, 5.0)), geometry) is None # Half a voxel
+    assert masks.grid_mapping(make_mask(np.eye(3), spacing=(0.4, 0.8, 2.5)), geometry) is None # Other spacing
+
+
+def test_logits_to_masks_multi_channel():
+    #* Same as the previous softmax -> argmax -> one-hot
+    logits = np.random.default_rng(0).normal(size=(3, 4, 8, 8)).astype(np.float32)
+    softmax = np.exp(logits) / np.exp(logits).sum(axis=1, keepdims=True)
+    expected = np.eye(4, dtype=np.uint8)[np.argmax(softmax, axis=1)].transpose(0, 3, 1, 2)
+
+    out = masks.logits_to_masks(logits)
+
+    assert out.dtype == np.uint8
+    np.testing.assert_array_equal(out, expected)
+
+
+def test_logits_to_masks_single_channel():
+    logits = np.random.default_rng(0).normal(size=(3, 1, 8, 8)).astype(np.float32)
+    expected = (1 / (1 + np.exp(-logits)) > 0.5).astype(np.uint8)
+
+    np.testing.assert_array_equal(masks.logits_to_masks(logits), expected)
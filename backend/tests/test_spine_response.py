@@ -0,0 +1,73 @@
+"""
+Spine labelling job: handling of the pipeline's output and the worker's warm app.
+"""
+import os
+
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('SimpleITK')
+pytest.importorskip('monailabel')
+
+import abcTK.inference.spine as spine
+from abcTK.writer import sanityWriter
+
+
+LABEL_JSON = {'label_names': {'L3': 22, 'L4': 23},
+              'centroids': [{'label_22': [22, 10, 20, 30]}, {'label_23': [23, 11, 21, 50]}]}
+
+
+@pytest.fixture
+def no_sanity(monkeypatch):
+    monkeypatch.setattr(sanityWriter, 'write_spine_sanity', lambda self, tag, *args: f'{tag}.png')
+
+
+def test_handle_response_moves_vertebra_mask(tmp_path, no_sanity):
+    label = tmp_path / 'prediction.nii.gz'
+    label.write_bytes(b'vertebra mask')
+    output_dir = tmp_path / 'output'
+    output_dir.mkdir()
+
+    res, output_filename = spine.handle_response(None, {'file': str(label), 'params': LABEL_JSON}, str(output_dir), None)
+
+    assert res['status_code'] == 200
+    assert res['mask_path'] == os.path.join(str(output_dir), 'masks', 'VERTEBRAE.nii.gz')
+    assert not label.exists()
+    with open(res['mask_path'], 'rb') as f:
+        assert f.read() == b'vertebra mask'
+    assert res['prediction'] == {'L3': [10, 20, 30], 'L4': [11, 21, 50]}
+    assert output_filename == 'SPINE.png'
+
+
+def test_handle_response_centroids_only(tmp_path, no_sanity):
+    res, _ = spine.handle_response(None, {'file': None, 'params': LABEL_JSON}, str(tmp_path), None)
+
+    assert res['status_code'] == 200
+    assert 'mask_path' not in res
+    assert not os.path.exists(os.path.join(str(tmp_path), 'masks'))
+
+
+def test_handle_response_no_centroids(tmp_path, no_sanity):
+    res, output_filename = spine.handle_response(None, {'file': None, 'params': None}, str(tmp_path), None)
+
+    assert res['status_code'] == 500
+    assert output_filename is None
+
+
+def test_get_app_adds_segmentation_to_the_same_app(monkeypatch):
+    class FakeApp():
+        def __init__(self, models):
+            self.models = models.split(',')
+
+        def add_models(self, models):
+            self.models += [x for x in models if x not in self.models]
+
+    created = []
+    monkeypatch.setattr(spine, '_app', None)
+    monkeypatch.setattr(spine, 'init_app', lambda models: created.append(FakeApp(models)) or created[-1])
+
+    app = spine.get_app(spine.CENTROID_MODELS)
+    assert spine.get_app(spine.SEGMENTATION_MODELS) is app
+    assert spine.get_app(spine.CENTROID_MODELS) is app
+    assert len(created) == 1
+    assert app.models == ['find_spine', 'find_vertebra', 'segment_vertebra']
@@ -0,0 +1,102 @@
+"""
+LoadedVolume (abcTK/volume.py): header-only geometry and slab reads against SimpleITK reading the whole file.
+"""
+import os
+
+import numpy as np
+import pytest
+
+sitk = pytest.importorskip('SimpleITK')
+
+from abcTK.volume import LoadedVolume
+
+SHAPE = (6, 10, 12) # z, y, x
+
+
+def make_image(direction=(1, 0, 0, 0, 1, 0, 0, 0, 1)):
+    Image = sitk.GetImageFromArray(np.arange(np.prod(SHAPE), dtype=np.int16).reshape(SHAPE))
+    Image.SetSpacing((0.7, 0.7, 2.5))
+    Image.SetOrigin((-40.0, 12.5, 300.0))
+    Image.SetDirection(direction)
+    return Image
+
+
+def write_dicom_series(Image, path):
+    #* One file per slice, with the tags ImageSeriesReader needs to sort and place them
+    writer = sitk.ImageFileWriter()
+    writer.KeepOriginalImageUIDOn()
+    direction = Image.GetDirection()
+    for k in range(Image.GetDepth()):
+        Slice = Image[:, :, k]
+        position = Image.TransformIndexToPhysicalPoint((0, 0, k))
+        tags = {'0008|0060': 'CT', '0010|0020': 'PATIENT1', '0020|000d': '1.2.3', '0020|000e': '1.2.3.4',
+                '0020|0013': str(k + 1), '0020|0032': '\\'.join(str(x) for x in position),
+                '0020|0037': '\\'.join(str(x) for x in direction[0::3] + direction[1::3]),
+                '0028|0030': '\\'.join(str(x) for x in Image.GetSpacing()[:2])}
+        for key, value in tags.items():
+            Slice.SetMetaData(key, value)
+        writer.SetFileName(os.path.join(path, f'{k:03d}.dcm'))
+        writer.Execute(Slice)
+    return path
+
+
+@pytest.fixture(params=['dicom', 'nifty', 'numpy'])
+def volume(request, tmp_path):
+    #* (LoadedVolume, image SimpleITK reads from the same file)
+    Image = make_image()
+    if request.param == 'dicom':
+        path = write_dicom_series(Image, str(tmp_path))
+        reader = sitk.ImageSeriesReader()
+        reader.SetFileNames(reader.GetGDCMSeriesFileNames(path))
+        return LoadedVolume(path, None, 'dicom'), reader.Execute()
+    elif request.param == 'nifty':
+        path = os.path.join(str(tmp_path), 'image.nii.gz')
+        sitk.WriteImage(Image, path)
+        return LoadedVolume(path, sitk.ReadImage, 'nifty'), sitk.ReadImage(path)
+
+    path = os.path.join(str(tmp_path), 'image.npy')
+    np.save(path, sitk.GetArrayFromImage(Image))
+    return LoadedVolume(path, lambda x: sitk.GetImageFromArray(np.load(x)), 'numpy'), sitk.GetImageFromArray(np.load(path))
+
+
+def test_probe_matches_image(volume):
+    volume, Image = volume
+
+    geometry = volume.geometry
+
+    assert not volume.is_loaded # Header only
+    assert tuple(geometry['size']) == Image.GetSize()
+    np.testing.assert_allclose(geometry['origin'], Image.GetOrigin(), atol=1e-4)
+    np.testing.assert_allclose(geometry['spacing'], Image.GetSpacing(), atol=1e-4)
+    np.testing.assert_allclose(geometry['direction'], Image.GetDirection(), atol=1e-4)
+
+
+def test_image_loaded_once(volume):
+    volume, Image = volume
+
+    assert volume.Image is volume.Image
+    np.testing.assert_array_equal(volume.array, sitk.GetArrayViewFromImage(Image))
+
+
+def test_read_slab_matches_image(volume):
+    volume, Image = volume
+    start, stop = 2, 5
+    assert volume.supports_slab
+
+    Slab = volume.read_slab(start, stop)
+
+    Expected = Image[:, :, start:stop]
+    assert not volume.is_loaded
+    np.testing.assert_array_equal(sitk.GetArrayViewFromImage(Slab), sitk.GetArrayViewFromImage(Expected))
+    np.testing.assert_allclose(Slab.GetOrigin(), Expected.GetOrigin(), atol=1e-4)
+    np.testing.assert_allclose(Slab.GetSpacing()[:2], Expected.GetSpacing()[:2], atol=1e-4)
+
+
+def test_dicom_header(tmp_path):
+    #* Tags of the first file are kept on the volume, without decoding the pixels
+    volume = LoadedVolume(write_dicom_series(make_image(), str(tmp_path)), None, 'dicom')
+
+    assert volume.read_header({'modality': '0008|0060', 'patient_id': '0010|0020', 'missing': '0018|0050'}) == \
+        {'modality': 'CT', 'patient_id': 'PATIENT1', 'missing': None}
+    assert not volume.is_loaded
+    assert volume.Image.GetMetaData('0008|0060') == 'CT'
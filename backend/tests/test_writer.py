@@ -0,0 +1,43 @@
+"""
+Segmentation sanity image (sanityWriter.write_all_segmentation_sanity) on synthetic masks.
+"""
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('SimpleITK')
+
+from abcTK.writer import sanityWriter
+
+SHAPE = (9, 48, 48)
+SLICE_NUMBER, NUM_SLICES = 4, 1
+
+
+@pytest.fixture
+def writer(tmp_path):
+    return sanityWriter(str(tmp_path), 'L3', SLICE_NUMBER, NUM_SLICES, window=400, level=50, modality='CT')
+
+
+@pytest.fixture
+def image():
+    return np.random.default_rng(0).uniform(-250, 250, SHAPE).astype(np.float32)
+
+
+def test_all_segmentation_sanity(writer, image):
+    masks = {x: np.zeros(SHAPE, dtype=np.int8) for x in ['skeletal_muscle', 'subcutaneous_fat']}
+    masks['skeletal_muscle'][:, 10:20, 10:30] = 1
+    masks['subcutaneous_fat'][:, 30:40, 10:30] = 1
+
+    paths = writer.write_all_segmentation_sanity('ALL', image, masks, {x: None for x in masks})
+
+    assert os.path.isfile(paths['L3'])
+
+
+def test_all_segmentation_sanity_empty_masks(writer, image):
+    #* Nothing segmented on the plotted slices, still writes the (uncoloured) slices
+    masks = {x: np.zeros(SHAPE, dtype=np.int8) for x in ['skeletal_muscle', 'subcutaneous_fat']}
+
+    paths = writer.write_all_segmentation_sanity('ALL', image, masks, {x: None for x in masks})
+
+    assert os.path.isfile(paths['L3'])